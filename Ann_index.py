@@ -0,0 +1,414 @@
+###########################################################################
+#This file contains the nearest neighbour indexes for the local search    #
+#exact: brute force scan, ivf: k-means buckets, hnsw: layered graph       #
+###########################################################################
+import os
+import glob
+import uuid
+import heapq
+import math
+import numpy as np
+
+def normalize(matrix):
+    '''
+    Scales every row of a matrix to unit length. Rows with a length of zero are left as zeros,
+    so they score 0 against every query just like the cosine_similarity udf in snowflake.
+
+    Arguments:
+    matrix      :        2d array of vectors
+
+    returns     :        a contiguous float32 matrix with unit length rows
+    '''
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    norms  = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return np.ascontiguousarray(matrix / norms, dtype=np.float32)
+
+def savez(path, **arrays):
+    '''
+    np.savez through a temporary file, so a worker loading the index never reads a half written file.
+    '''
+    with open(path + ".tmp", mode="wb") as fl:
+        np.savez(fl, **arrays)
+    os.replace(path + ".tmp", path)
+
+def top_k(scores, limit):
+    '''
+    Finds the positions of the highest scores without sorting the whole array.
+
+    Arguments:
+    scores      :        1d array of scores
+    limit       :        the amount of positions to return
+
+    returns     :        positions of the best scores, best first
+    '''
+    limit = min(limit, len(scores))
+    if limit <= 0:
+        return np.empty(0, dtype=np.int64)
+    if limit < len(scores):
+        best = np.argpartition(-scores, limit - 1)[:limit]
+    else:
+        best = np.arange(len(scores))
+    return best[np.argsort(-scores[best], kind="stable")]
+
+class ExactIndex:
+    '''
+    Scores the query against every vector. Always correct, the cost grows with the size of the corpus.
+
+    Arguments:
+    vectors     :        2d array of unit length vectors
+    '''
+    kind = "exact"
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    def search(self, query, limit=3):
+        '''
+        Arguments:
+        query       :        unit length query vector
+        limit       :        (Optional) the amount of results
+
+        returns     :        positions and cosine similarities of the closest vectors, best first
+        '''
+        scores = self.vectors @ query
+        best   = top_k(scores, limit)
+        return best, scores[best]
+
+    def search_many(self, queries, limit=3, chunk_size=2**25):
+        '''
+        Scores many queries with matrix-matrix products, in chunks so the score matrix stays below chunk_size floats.
+
+        Arguments:
+        queries     :        2d array of unit length query vectors
+        limit       :        (Optional) the amount of results per query
+
+        returns     :        list of (positions, cosine similarities) per query, best first
+        '''
+        results = []
+        step    = max(1, chunk_size // max(1, len(self.vectors)))
+        for start in range(0, len(queries), step):
+            scores = queries[start:start + step] @ self.vectors.T
+            for row in scores:
+                best = top_k(row, limit)
+                results.append((best, row[best]))
+        return results
+
+    def extend(self, vectors):
+        '''
+        Adds vectors to the index. vectors is the whole new matrix, the old vectors are its first rows.
+        '''
+        self.vectors = vectors
+
+    def save(self, path):
+        savez(path, kind=self.kind, count=len(self.vectors))
+
+    @classmethod
+    def load(cls, data, vectors, path):
+        return cls(vectors)
+
+def assign_lists(vectors, centroids, chunk=65536):
+    '''
+    Finds the closest centroid of every vector, in chunks so the score matrix stays small.
+    '''
+    assigned = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), chunk):
+        assigned[start:start + chunk] = np.argmax(vectors[start:start + chunk] @ centroids.T, axis=1)
+    return assigned
+
+def kmeans(vectors, nlist, iterations=10, sample_per_list=64, seed=0):
+    '''
+    Spherical k-means: clusters unit length vectors by cosine similarity.
+
+    Arguments:
+    vectors         :    2d array of unit length vectors
+    nlist           :    the amount of clusters
+    iterations      :    (Optional) the amount of refinement steps
+    sample_per_list :    (Optional) train on at most nlist*sample_per_list random vectors
+    seed            :    (Optional) seed of the random generator
+
+    returns     :        the centroids as a 2d array
+    '''
+    rng   = np.random.default_rng(seed)
+    train = vectors
+    if len(vectors) > nlist * sample_per_list:
+        train = vectors[np.sort(rng.choice(len(vectors), nlist * sample_per_list, replace=False))]
+    train     = np.ascontiguousarray(train, dtype=np.float32)
+    centroids = train[rng.choice(len(train), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assigned = assign_lists(train, centroids)
+        sums     = np.zeros_like(centroids)
+        np.add.at(sums, assigned, train)
+        empty = np.bincount(assigned, minlength=nlist) == 0
+        #clusters that lost all their vectors restart from a random vector
+        sums[empty] = train[rng.choice(len(train), int(empty.sum()))]
+        centroids = normalize(sums)
+    return centroids
+
+class IVFIndex:
+    '''
+    Inverted file index: the vectors are grouped into nlist buckets around k-means centroids and a search
+    only scans the nprobe buckets with the closest centroids. More nprobe means better recall and slower queries.
+
+    Arguments:
+    vectors     :        2d array of unit length vectors
+    nlist       :        (Optional) the amount of buckets, defaults to 4*sqrt(len(vectors))
+    nprobe      :        (Optional) the amount of buckets scanned per query
+    iterations  :        (Optional) the amount of k-means steps
+    seed        :        (Optional) seed of the random generator
+    sorted_vectors:      (Optional) the vectors already sorted by bucket, e.g. memory mapped by load()
+    '''
+    kind = "ivf"
+
+    def __init__(self, vectors, nlist=None, nprobe=8, iterations=10, seed=0, buckets=None, sorted_vectors=None):
+        self.vectors = vectors
+        self.nprobe  = nprobe
+        if buckets is None:
+            nlist     = nlist or max(1, int(4 * math.sqrt(len(vectors))))
+            centroids = kmeans(vectors, min(nlist, len(vectors)), iterations=iterations, seed=seed)
+            assigned  = assign_lists(vectors, centroids)
+            ids       = np.argsort(assigned, kind="stable")
+            offsets   = np.concatenate([[0], np.cumsum(np.bincount(assigned, minlength=len(centroids)))])
+            buckets   = (centroids, ids, offsets)
+        self.centroids, self.ids, self.offsets = buckets
+        #the buckets are stored as one contiguous copy of the vectors sorted by bucket,
+        #so every bucket is a slice and scanning it doesn't gather rows. save() writes the copy
+        #next to the index and load() memory maps it, so the workers share it like the store
+        self.sorted  = sorted_vectors if sorted_vectors is not None else np.ascontiguousarray(vectors[self.ids])
+
+    def search(self, query, limit=3, nprobe=None):
+        '''
+        Arguments:
+        query       :        unit length query vector
+        limit       :        (Optional) the amount of results
+        nprobe      :        (Optional) the amount of buckets to scan, defaults to self.nprobe
+
+        returns     :        positions and cosine similarities of the closest vectors, best first
+        '''
+        nprobe    = min(nprobe or self.nprobe, len(self.centroids))
+        lists     = top_k(self.centroids @ query, nprobe)
+        positions = np.concatenate([self.ids[self.offsets[l]:self.offsets[l + 1]] for l in lists])
+        scores    = np.concatenate([self.sorted[self.offsets[l]:self.offsets[l + 1]] @ query for l in lists])
+        best      = top_k(scores, limit)
+        return positions[best], scores[best]
+
+    def search_many(self, queries, limit=3):
+        return [self.search(query, limit) for query in queries]
+
+    def extend(self, vectors):
+        '''
+        Adds vectors to the index. vectors is the whole new matrix, the old vectors are its first rows.
+        The new vectors go to the bucket of their closest centroid, the centroids are not trained again.
+        '''
+        start              = len(self.vectors)
+        assigned           = np.empty(len(vectors), dtype=np.int64)
+        assigned[self.ids] = np.repeat(np.arange(len(self.centroids)), np.diff(self.offsets))
+        assigned[start:]   = assign_lists(vectors[start:], self.centroids)
+        self.vectors = vectors
+        self.ids     = np.argsort(assigned, kind="stable")
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assigned, minlength=len(self.centroids)))])
+        self.sorted  = np.ascontiguousarray(vectors[self.ids])
+
+    @staticmethod
+    def sorted_path(path, build):
+        return f"{os.path.splitext(path)[0]}.{build}.sorted.npy"
+
+    def save(self, path):
+        #every save writes its sorted vectors to a file of its own, named by a build id that the index
+        #file records, so an index is never loaded with the sorted vectors of another save
+        build = uuid.uuid4().hex
+        with open(self.sorted_path(path, build) + ".tmp", mode="wb") as fl:
+            np.save(fl, np.asarray(self.sorted))
+        os.replace(self.sorted_path(path, build) + ".tmp", self.sorted_path(path, build))
+        savez(path, kind=self.kind, count=len(self.vectors), nprobe=self.nprobe, centroids=self.centroids, ids=self.ids, offsets=self.offsets, build=build)
+        for old in glob.glob(self.sorted_path(path, "*")):
+            if old != self.sorted_path(path, build):
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+
+    @classmethod
+    def load(cls, data, vectors, path):
+        sorted_vectors = None
+        if "build" in data:
+            try:
+                sorted_vectors = np.load(cls.sorted_path(path, str(data["build"])), mmap_mode="r")
+            except FileNotFoundError:
+                #removed by a newer save, make the copy in memory instead
+                sorted_vectors = None
+        if sorted_vectors is not None and sorted_vectors.shape != vectors.shape:
+            sorted_vectors = None
+        return cls(vectors, nprobe=int(data["nprobe"]), buckets=(data["centroids"], data["ids"], data["offsets"]), sorted_vectors=sorted_vectors)
+
+class HNSWIndex:
+    '''
+    Hierarchical navigable small world graph: every vector is linked to its closest neighbours on one
+    or more layers and a search walks the graph from the top layer down. More ef means better recall
+    and slower queries. Building is done in python (~1ms per vector), so for millions of vectors use ivf.
+
+    Arguments:
+    vectors         :    2d array of unit length vectors
+    M               :    (Optional) the amount of links per vector, twice as many on the bottom layer
+    ef_construction :    (Optional) the amount of candidates considered while linking
+    ef              :    (Optional) the amount of candidates considered per query
+    seed            :    (Optional) seed of the random generator
+    '''
+    kind = "hnsw"
+
+    def __init__(self, vectors, M=16, ef_construction=100, ef=50, seed=0, graph=None):
+        self.vectors         = vectors
+        self.M               = M
+        self.ef_construction = ef_construction
+        self.ef              = ef
+        if graph is not None:
+            self.layers, self.entry = graph
+            return
+        self.layers = []
+        self.entry  = None
+        rng         = np.random.default_rng(seed)
+        levels      = np.floor(-np.log(1 - rng.random(len(vectors))) / math.log(M)).astype(int)
+        for i, level in enumerate(levels):
+            self._insert(i, level)
+
+    def _similarities(self, query, nodes):
+        return self.vectors[nodes] @ query
+
+    def _search_layer(self, query, entries, ef, layer):
+        graph     = self.layers[layer]
+        scores    = self._similarities(query, entries)
+        visited   = set(entries)
+        #candidates is a max heap on similarity, found is a min heap holding the best ef nodes
+        candidates = [(-s, n) for s, n in zip(scores.tolist(), entries)]
+        found      = [(s, n) for s, n in zip(scores.tolist(), entries)]
+        heapq.heapify(candidates)
+        heapq.heapify(found)
+        while len(found) > ef:
+            heapq.heappop(found)
+        while candidates:
+            score, node = heapq.heappop(candidates)
+            if -score < found[0][0] and len(found) >= ef:
+                break
+            neighbours = [n for n in graph.get(node, ()) if n not in visited]
+            if not neighbours:
+                continue
+            visited.update(neighbours)
+            for s, n in zip(self._similarities(query, neighbours).tolist(), neighbours):
+                if len(found) < ef or s > found[0][0]:
+                    heapq.heappush(candidates, (-s, n))
+                    heapq.heappush(found, (s, n))
+                    if len(found) > ef:
+                        heapq.heappop(found)
+        return sorted(found, reverse=True)
+
+    def _shrink(self, node, layer, max_links):
+        links = self.layers[layer][node]
+        if len(links) > max_links:
+            scores = self._similarities(self.vectors[node], links)
+            self.layers[layer][node] = [links[i] for i in top_k(scores, max_links)]
+
+    def _insert(self, node, level):
+        query = self.vectors[node]
+        top   = len(self.layers) - 1
+        while len(self.layers) <= level:
+            self.layers.append({})
+        for layer in range(level + 1):
+            self.layers[layer][node] = []
+        if self.entry is None:
+            self.entry = node
+            return
+        entries = [self.entry]
+        for layer in range(top, level, -1):
+            entries = [self._search_layer(query, entries, 1, layer)[0][1]]
+        for layer in range(min(level, top), -1, -1):
+            found      = self._search_layer(query, entries, self.ef_construction, layer)
+            neighbours = [n for _, n in found[:self.M]]
+            max_links  = self.M * 2 if layer == 0 else self.M
+            self.layers[layer][node] = neighbours
+            for n in neighbours:
+                self.layers[layer][n].append(node)
+                self._shrink(n, layer, max_links)
+            entries = [n for _, n in found]
+        if level > top:
+            self.entry = node
+
+    def search(self, query, limit=3, ef=None):
+        '''
+        Arguments:
+        query       :        unit length query vector
+        limit       :        (Optional) the amount of results
+        ef          :        (Optional) the amount of candidates considered, defaults to self.ef
+
+        returns     :        positions and cosine similarities of the closest vectors, best first
+        '''
+        if self.entry is None:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        entries = [self.entry]
+        for layer in range(len(self.layers) - 1, 0, -1):
+            entries = [self._search_layer(query, entries, 1, layer)[0][1]]
+        found = self._search_layer(query, entries, max(ef or self.ef, limit), 0)[:limit]
+        return np.array([n for _, n in found], dtype=np.int64), np.array([s for s, _ in found], dtype=np.float32)
+
+    def search_many(self, queries, limit=3):
+        return [self.search(query, limit) for query in queries]
+
+    def extend(self, vectors):
+        '''
+        Adds vectors to the index. vectors is the whole new matrix, the old vectors are its first rows.
+        '''
+        start        = len(self.vectors)
+        self.vectors = vectors
+        rng          = np.random.default_rng(start)
+        levels       = np.floor(-np.log(1 - rng.random(len(vectors) - start)) / math.log(self.M)).astype(int)
+        for i, level in enumerate(levels, start=start):
+            self._insert(i, level)
+
+    def save(self, path):
+        #every layer is saved as a csr graph: nodes, offsets into links, links
+        arrays = {"kind": self.kind, "count": len(self.vectors), "entry": self.entry, "M": self.M, "ef": self.ef, "ef_construction": self.ef_construction}
+        for layer, graph in enumerate(self.layers):
+            nodes = np.array(sorted(graph), dtype=np.int64)
+            arrays[f"nodes_{layer}"]   = nodes
+            arrays[f"offsets_{layer}"] = np.concatenate([[0], np.cumsum([len(graph[n]) for n in nodes])]).astype(np.int64)
+            arrays[f"links_{layer}"]   = np.array([l for n in nodes for l in graph[n]], dtype=np.int64)
+        savez(path, layers=len(self.layers), **arrays)
+
+    @classmethod
+    def load(cls, data, vectors, path):
+        layers = []
+        for layer in range(int(data["layers"])):
+            nodes, offsets, links = data[f"nodes_{layer}"], data[f"offsets_{layer}"], data[f"links_{layer}"].tolist()
+            layers.append({int(n): links[offsets[i]:offsets[i + 1]] for i, n in enumerate(nodes)})
+        entry = int(data["entry"]) if layers else None
+        return cls(vectors, M=int(data["M"]), ef_construction=int(data["ef_construction"]), ef=int(data["ef"]), graph=(layers, entry))
+
+INDEXES = {index.kind: index for index in (ExactIndex, IVFIndex, HNSWIndex)}
+
+def build_index(kind, vectors, **options):
+    '''
+    Arguments:
+    kind        :        "exact", "ivf" or "hnsw"
+    vectors     :        2d array of unit length vectors
+    options     :        (Optional) passed on to the index, e.g. nlist/nprobe for ivf or M/ef for hnsw
+
+    returns     :        the index
+    '''
+    if kind not in INDEXES:
+        raise ValueError(f"Unknown index {kind!r}, choose from {sorted(INDEXES)}")
+    return INDEXES[kind](vectors, **options)
+
+def load_index(path, vectors):
+    '''
+    Loads an index saved with index.save(path). The vectors are not part of the file,
+    pass the same vectors the index was built from.
+
+    Arguments:
+    path        :        the .npz file
+    vectors     :        2d array of unit length vectors
+
+    returns     :        the index
+    '''
+    with np.load(path) as data:
+        if int(data["count"]) != len(vectors):
+            raise ValueError(f"{path} was built from {int(data['count'])} vectors, but {len(vectors)} were given")
+        return INDEXES[str(data["kind"])].load(data, vectors, path)
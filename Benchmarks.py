@@ -0,0 +1,288 @@
+###########################################################################
+#This file contains benchmarks that run against the stubs in Stubs.py     #
+#Usage: python Benchmarks.py <benchmark> [options]                        #
+###########################################################################
+import os
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+#the stubs replace the real clients, so no credentials are needed
+for key in ["OPENAI_KEY", "SNOWSQL_PWD", "WAREHOUSE", "SNOWSQL_ACC", "SNOWSQL_USR", "SNOWSQL_DB", "SNOWSQL_SCHEMA"]:
+    os.environ.setdefault(key, "stub")
+
+import Embeddings
+import Embedding_cache
+import Stubs
+import Ann_index
+import Vector_store
+import Local_search
+import Metrics
+import Search
+
+def load_quotes(count=None):
+    quotes = pd.read_json("data.json")["quote"].tolist()
+    return quotes[:count] if count else quotes
+
+def bench_embeddings(args):
+    '''
+    Compares quotes/second of one request per quote against batched, concurrent requests.
+    '''
+    quotes = load_quotes(args.count)
+    #a cache would hide the cost of the requests
+    Embedding_cache.set_cache(Embedding_cache.EmbeddingCache(path=None, maxsize=0))
+
+    Embeddings.client = Stubs.StubEmbeddingClient(latency=args.latency)
+    start = time.perf_counter()
+    for quote in quotes:
+        Embeddings.get_embeddings(quote)
+    sequential = time.perf_counter() - start
+
+    Embeddings.client = Stubs.StubEmbeddingClient(latency=args.latency, rate_limit_every=args.rate_limit_every)
+    start = time.perf_counter()
+    Embeddings.get_embeddings_bulk(quotes, batch_size=args.batch_size, workers=args.workers)
+    batched = time.perf_counter() - start
+
+    print(f"quotes            : {len(quotes)}")
+    print(f"sequential        : {len(quotes)/sequential:10.1f} quotes/s ({sequential:.2f}s)")
+    print(f"batched           : {len(quotes)/batched:10.1f} quotes/s ({batched:.2f}s, "
+          f"{Embeddings.client.requests} requests, batch_size={args.batch_size}, workers={args.workers})")
+    print(f"speedup           : {sequential/batched:10.1f}x")
+
+def synthetic_vectors(count, dimension, clusters=100, seed=0):
+    '''
+    Makes clustered unit length vectors, a corpus with structure like real embeddings.
+    '''
+    rng     = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dimension))
+    labels  = rng.integers(0, clusters, count)
+    return Ann_index.normalize(centers[labels] + 0.8 * rng.standard_normal((count, dimension)))
+
+def measure(index, queries, truth, k, **knobs):
+    start   = time.perf_counter()
+    results = [index.search(query, k, **knobs)[0] for query in queries]
+    seconds = time.perf_counter() - start
+    recall  = np.mean([len(set(found.tolist()) & exact) / len(exact) for found, exact in zip(results, truth)])
+    return recall, len(queries) / seconds
+
+def bench_index(name, vectors, queries, args):
+    exact = Ann_index.ExactIndex(vectors)
+    truth = [set(exact.search(query, args.k)[0].tolist()) for query in queries]
+    recall, qps = measure(exact, queries, truth, args.k)
+    print(f"{name}: {len(vectors)} vectors, dimension {vectors.shape[1]}, {len(queries)} queries")
+    print(f"  {'index':<6}{'knob':<12}{'recall@' + str(args.k):>10}{'QPS':>12}")
+    print(f"  {'exact':<6}{'':<12}{recall:>10.3f}{qps:>12.1f}")
+
+    start = time.perf_counter()
+    ivf   = Ann_index.IVFIndex(vectors)
+    print(f"  ivf: {len(ivf.centroids)} lists built in {time.perf_counter() - start:.2f}s")
+    for nprobe in args.nprobe:
+        recall, qps = measure(ivf, queries, truth, args.k, nprobe=nprobe)
+        print(f"  {'ivf':<6}{'nprobe=' + str(nprobe):<12}{recall:>10.3f}{qps:>12.1f}")
+
+    if args.hnsw_count:
+        subset = vectors[:args.hnsw_count]
+        exact  = Ann_index.ExactIndex(subset)
+        truth  = [set(exact.search(query, args.k)[0].tolist()) for query in queries]
+        start  = time.perf_counter()
+        hnsw   = Ann_index.HNSWIndex(subset)
+        print(f"  hnsw: first {len(subset)} vectors built in {time.perf_counter() - start:.2f}s")
+        for ef in args.ef:
+            recall, qps = measure(hnsw, queries, truth, args.k, ef=ef)
+            print(f"  {'hnsw':<6}{'ef=' + str(ef):<12}{recall:>10.3f}{qps:>12.1f}")
+
+def bench_ann(args):
+    '''
+    Compares recall@k and queries/second of the ivf and hnsw indexes against the exact top-k.
+    '''
+    vectors = synthetic_vectors(args.count + args.queries, args.dimension)
+    bench_index("synthetic", vectors[args.queries:], vectors[:args.queries], args)
+    if Vector_store.exists(args.store):
+        vectors, meta = Vector_store.load_store(args.store)
+        rng           = np.random.default_rng(1)
+        #perturbed corpus vectors stand in for real queries
+        queries       = Ann_index.normalize(vectors[rng.integers(0, len(vectors), args.queries)] + 0.02 * rng.standard_normal((args.queries, vectors.shape[1])))
+        bench_index(args.store, vectors, queries, args)
+
+def bench_snowflake(args):
+    '''
+    Fires parallel searches through Snowflake_tools against stub connections. Every query is a quote
+    from the corpus, so its own quote must come back first, any other answer means results leaked
+    between requests. Reports queries/second for every amount of parallel requests.
+    '''
+    import Snowflake_tools
+
+    df      = pd.read_json("data.json")
+    quotes  = df["quote"].tolist()
+    vectors = np.array([Stubs.fake_embedding(quote, args.dimension) for quote in quotes], dtype=np.float32)
+    Embedding_cache.set_cache(Embedding_cache.EmbeddingCache(path=None))
+    Embeddings.client = Stubs.StubEmbeddingClient(dimension=args.dimension, latency=0)
+
+    rng     = np.random.default_rng(0)
+    queries = [quotes[i] for i in rng.integers(0, len(quotes), args.queries)]
+    leaked  = 0
+    print(f"{args.queries} queries, {args.latency * 1000:.0f}ms per stub query")
+    for parallel in args.parallel:
+        Snowflake_tools.pool = Snowflake_tools.ConnectionPool(
+            lambda: Stubs.StubSnowflakeConnection(quotes, df["movie"].tolist(), vectors, latency=args.latency),
+            size=parallel,
+        )
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=parallel) as pool:
+            results = list(pool.map(Snowflake_tools.search_query, queries))
+        seconds = time.perf_counter() - start
+        wrong   = sum(result[0]["QUOTE"] != query for query, result in zip(queries, results))
+        leaked += wrong
+        print(f"  parallel={parallel:<4}{len(queries)/seconds:10.1f} queries/s   wrong results: {wrong}")
+        Snowflake_tools.pool.close()
+    if leaked:
+        raise SystemExit(f"{leaked} searches returned the results of another request")
+
+def bench_batch(args):
+    '''
+    Compares queries/second of looping Local_search.search_query against one Local_search.search_many call.
+    '''
+    df      = pd.read_json("data.json")
+    quotes  = df["quote"].tolist()
+    vectors = np.array([Stubs.fake_embedding(quote) for quote in quotes], dtype=np.float32)
+    if args.corpus > len(quotes):
+        #pad the corpus with random vectors to get closer to a real size
+        extra   = synthetic_vectors(args.corpus - len(quotes), vectors.shape[1])
+        vectors = np.concatenate([vectors, extra])
+        quotes  = quotes + [f"padding {i}" for i in range(len(extra))]
+    Local_search.engine.set(Local_search.LocalSearch(vectors, quotes, quotes))
+
+    rng     = np.random.default_rng(0)
+    queries = [f"{quotes[i]} #{n}" for n, i in enumerate(rng.integers(0, len(df), args.queries))]
+
+    for name, run in [("looped search_query", lambda: [Local_search.search_query(query, args.k) for query in queries]),
+                      ("search_many", lambda: Local_search.search_many(queries, args.k))]:
+        #every run starts with an empty cache, so the embedding requests are counted
+        Embedding_cache.set_cache(Embedding_cache.EmbeddingCache(path=None, maxsize=0))
+        Embeddings.client = Stubs.StubEmbeddingClient(latency=args.latency)
+        start   = time.perf_counter()
+        run()
+        seconds = time.perf_counter() - start
+        print(f"{name:<20}: {len(queries)/seconds:10.1f} queries/s ({seconds:.2f}s, {Embeddings.client.requests} embedding requests)")
+
+def make_query_log(count, seed=0):
+    '''
+    Makes a query log from data.json: the start of a quote, a few words of a quote or a movie title.
+    Popular queries repeat, like in a real log.
+    '''
+    rng     = np.random.default_rng(seed)
+    df      = pd.read_json("data.json")
+    queries = []
+    for i in rng.integers(0, len(df), max(1, count // 3)):
+        words = df["quote"][i].split()
+        kind  = rng.integers(0, 3)
+        if kind == 0:
+            queries.append(" ".join(words[:4]))
+        elif kind == 1:
+            queries.append(" ".join(rng.choice(words, min(3, len(words)), replace=False)))
+        else:
+            queries.append(df["movie"][i])
+    popularity = 1 / np.arange(1, len(queries) + 1)
+    return [queries[i] for i in rng.choice(len(queries), count, p=popularity / popularity.sum())]
+
+def bench_replay(args):
+    '''
+    Replays a query log against the flask app with stubbed embedding and warehouse backends
+    and prints how long every stage of the search path took.
+    '''
+    import Snowflake_tools
+    #the stubs are set after the import, a warm-up would load the real backends
+    os.environ["WARM_UP"] = "0"
+    import app
+
+    if args.log:
+        with open(args.log) as fl:
+            queries = [line.strip() for line in fl if line.strip()]
+    else:
+        queries = make_query_log(args.queries)
+
+    df      = pd.read_json("data.json")
+    vectors = np.array([Stubs.fake_embedding(quote) for quote in df["quote"]], dtype=np.float32)
+    Embedding_cache.set_cache(Embedding_cache.EmbeddingCache(path=None))
+    Embeddings.client    = Stubs.StubEmbeddingClient(latency=args.embed_latency)
+    Local_search.engine.set(Local_search.LocalSearch(vectors, df["quote"], df["movie"], types=df["type"], years=df["year"]))
+    Snowflake_tools.pool = Snowflake_tools.ConnectionPool(
+        lambda: Stubs.StubSnowflakeConnection(
+            df["quote"].tolist(), df["movie"].tolist(), Ann_index.normalize(vectors), latency=args.warehouse_latency,
+            types=df["type"].tolist(), years=df["year"].tolist(),
+        ),
+    )
+    Search.BACKEND = args.backend
+    Search.MODE    = args.mode
+    Metrics.registry.reset()
+
+    client = app.app.test_client()
+    failed = 0
+    start  = time.perf_counter()
+    for query in queries:
+        if client.get("/search", query_string={"query": query}).status_code != 200:
+            failed += 1
+    seconds = time.perf_counter() - start
+
+    print(f"{len(queries)} queries, backend={args.backend}, mode={args.mode}: {len(queries)/seconds:.1f} requests/s, {failed} failed")
+    print(f"  {'stage':<22}{'count':>7}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage, stats in sorted(Metrics.registry.snapshot().items(), key=lambda item: -item[1]["mean"] * item[1]["count"]):
+        print(f"  {stage:<22}{stats['count']:>7}" + "".join(f"{stats[key] * 1000:>10.2f}" for key in ["mean", "p50", "p95", "p99"]))
+    cache = Embedding_cache.get_cache().stats()
+    print(f"  embedding cache hit rate {cache['hit_rate']:.2f}, lexical fast path {Metrics.registry.counters['search_fast_path_total']} times")
+    if failed:
+        raise SystemExit(f"{failed} of {len(queries)} requests failed, the timings above include them")
+
+def main():
+    parser     = argparse.ArgumentParser(description=__doc__)
+    benchmarks = parser.add_subparsers(dest="benchmark", required=True)
+
+    embeddings = benchmarks.add_parser("embeddings", help="sequential vs. batched embedding generation")
+    embeddings.add_argument("--count", type=int, default=None, help="amount of quotes from data.json, all by default")
+    embeddings.add_argument("--latency", type=float, default=0.02, help="seconds per stub request")
+    embeddings.add_argument("--batch-size", type=int, default=64)
+    embeddings.add_argument("--workers", type=int, default=4)
+    embeddings.add_argument("--rate-limit-every", type=int, default=0, help="make every n-th request fail with a 429")
+    embeddings.set_defaults(run=bench_embeddings)
+
+    ann = benchmarks.add_parser("ann", help="recall@k and QPS of the ivf and hnsw indexes against exact search")
+    ann.add_argument("--count", type=int, default=100_000, help="amount of synthetic vectors")
+    ann.add_argument("--dimension", type=int, default=256)
+    ann.add_argument("--queries", type=int, default=200)
+    ann.add_argument("-k", type=int, default=10)
+    ann.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    ann.add_argument("--ef", type=int, nargs="+", default=[10, 50, 100])
+    ann.add_argument("--hnsw-count", type=int, default=5000, help="hnsw is built from the first n vectors, 0 skips it")
+    ann.add_argument("--store", default=Vector_store.STORE_PATH, help="also benchmark the real vectors of this store, if it exists")
+    ann.set_defaults(run=bench_ann)
+
+    snowflake = benchmarks.add_parser("snowflake", help="parallel searches through the snowflake connection pool")
+    snowflake.add_argument("--queries", type=int, default=200)
+    snowflake.add_argument("--latency", type=float, default=0.05, help="seconds per stub query")
+    snowflake.add_argument("--dimension", type=int, default=64)
+    snowflake.add_argument("--parallel", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    snowflake.set_defaults(run=bench_snowflake)
+
+    batch = benchmarks.add_parser("batch", help="search_many vs. looping search_query on the local backend")
+    batch.add_argument("--queries", type=int, default=500)
+    batch.add_argument("--corpus", type=int, default=20_000, help="size of the corpus, padded with random vectors")
+    batch.add_argument("--latency", type=float, default=0.02, help="seconds per stub embedding request")
+    batch.add_argument("-k", type=int, default=3)
+    batch.set_defaults(run=bench_batch)
+
+    replay = benchmarks.add_parser("replay", help="per-stage latency of the app replaying a query log")
+    replay.add_argument("--log", help="file with one query per line, made from data.json by default")
+    replay.add_argument("--queries", type=int, default=500, help="length of the generated log")
+    replay.add_argument("--backend", choices=sorted(Search.BACKENDS), default="local")
+    replay.add_argument("--mode", choices=Search.MODES, default="hybrid")
+    replay.add_argument("--embed-latency", type=float, default=0.02, help="seconds per stub embedding request")
+    replay.add_argument("--warehouse-latency", type=float, default=0.05, help="seconds per stub warehouse query")
+    replay.set_defaults(run=bench_replay)
+
+    args = parser.parse_args()
+    args.run(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+###########################################################################
+#This file contains a two tier cache for embeddings                       #
+#memory (LRU with TTL) in front of a sqlite file shared between processes #
+###########################################################################
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+CACHE_PATH = os.getenv("EMBEDDING_CACHE", "embedding_cache.sqlite")
+CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "10000"))
+CACHE_TTL  = float(os.getenv("EMBEDDING_CACHE_TTL", "86400"))
+
+_cache = None
+
+def normalize_text(string : str):
+    '''
+    Makes strings that only differ in unicode form or whitespace share one cache entry.
+    '''
+    return " ".join(unicodedata.normalize("NFKC", string).split())
+
+def cache_key(model : str, string : str):
+    return hashlib.sha256(f"{model}\0{normalize_text(string)}".encode("utf-8")).hexdigest()
+
+class LRUCache:
+    '''
+    In-process cache that drops the least recently used entry when full and entries older than ttl.
+
+    Arguments:
+    maxsize     :        (Optional) max amount of entries, 0 turns the cache off
+    ttl         :        (Optional) seconds an entry stays valid, None keeps entries until they are pushed out
+    '''
+    def __init__(self, maxsize=CACHE_SIZE, ttl=CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl     = ttl
+        self._items  = OrderedDict()
+        self._lock   = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            added, value = item
+            if self.ttl is not None and time.monotonic() - added > self.ttl:
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._items[key] = (time.monotonic(), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+class DiskCache:
+    '''
+    Persistent cache in a sqlite file. The app workers and Quotes.py can use the same file at the same time.
+
+    Arguments:
+    path        :        path of the sqlite file
+    '''
+    def __init__(self, path=CACHE_PATH):
+        self.path   = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, model TEXT, vector BLOB, created REAL)")
+
+    def _connect(self):
+        #sqlite connections can't be shared between threads, so every thread opens its own
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get_many(self, keys : list):
+        found = {}
+        conn  = self._connect()
+        #sqlite allows at most 999 parameters in one query
+        for start in range(0, len(keys), 900):
+            chunk = keys[start:start + 900]
+            rows  = conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+            for key, vector in rows:
+                found[key] = np.frombuffer(vector, dtype=np.float32).tolist()
+        return found
+
+    def put_many(self, items : list):
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)",
+                [(key, model, np.asarray(vector, dtype=np.float32).tobytes(), now) for key, model, vector in items],
+            )
+
+class EmbeddingCache:
+    '''
+    Looks up embeddings in memory first and on disk second, and counts hits and misses.
+
+    Arguments:
+    path        :        (Optional) path of the sqlite file, None keeps the cache in memory only
+    maxsize     :        (Optional) max amount of entries in memory
+    ttl         :        (Optional) seconds an entry stays in memory
+    '''
+    def __init__(self, path=CACHE_PATH, maxsize=CACHE_SIZE, ttl=CACHE_TTL):
+        self.memory  = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.disk    = DiskCache(path) if path else None
+        self.counts  = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        self._lock   = threading.Lock()
+
+    def get_many(self, strings : list, model="text-embedding-3-small"):
+        '''
+        Arguments:
+        strings     :        the strings to look up
+        model       :        (Optional) the model of the embeddings
+
+        returns     :        dictionary of position -> embeddings for the strings that were found
+        '''
+        keys       = [cache_key(model, string) for string in strings]
+        found      = {}
+        on_disk    = []
+        for i, key in enumerate(keys):
+            vector = self.memory.get(key)
+            if vector is None:
+                on_disk.append(i)
+            else:
+                found[i] = vector
+        memory_hits = len(found)
+
+        if on_disk and self.disk is not None:
+            from_disk = self.disk.get_many(list({keys[i] for i in on_disk}))
+            for i in on_disk:
+                if keys[i] in from_disk:
+                    found[i] = from_disk[keys[i]]
+                    self.memory.put(keys[i], found[i])
+
+        with self._lock:
+            self.counts["memory_hits"] += memory_hits
+            self.counts["disk_hits"]   += len(found) - memory_hits
+            self.counts["misses"]      += len(strings) - len(found)
+        return found
+
+    def get(self, string : str, model="text-embedding-3-small"):
+        return self.get_many([string], model=model).get(0)
+
+    def put_many(self, strings : list, vectors : list, model="text-embedding-3-small"):
+        keys = [cache_key(model, string) for string in strings]
+        for key, vector in zip(keys, vectors):
+            self.memory.put(key, vector)
+        if self.disk is not None:
+            self.disk.put_many([(key, model, vector) for key, vector in zip(keys, vectors)])
+
+    def put(self, string : str, vector : list, model="text-embedding-3-small"):
+        self.put_many([string], [vector], model=model)
+
+    def stats(self):
+        '''
+        returns     :        the hit and miss counters and the hit rate as a dictionary
+        '''
+        with self._lock:
+            stats = dict(self.counts)
+        lookups              = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"]    = (lookups - stats["misses"]) / lookups if lookups else 0.0
+        stats["memory_size"] = len(self.memory)
+        return stats
+
+def get_cache():
+    '''
+    Creates the cache on first use, set by the EMBEDDING_CACHE, EMBEDDING_CACHE_SIZE and EMBEDDING_CACHE_TTL env variables.
+    An empty EMBEDDING_CACHE keeps the cache in memory only.
+    '''
+    global _cache
+    if _cache is None:
+        _cache = EmbeddingCache(path=CACHE_PATH or None)
+    return _cache
+
+def cache_stats():
+    '''
+    returns     :        the stats of the cache, None when it wasn't created yet (creating it would create the sqlite file)
+    '''
+    return _cache.stats() if _cache is not None else None
+
+def set_cache(cache):
+    global _cache
+    _cache = cache
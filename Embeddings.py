@@ -3,47 +3,210 @@
 ###########################################################################
 import requests
 import os
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import json
-from openai import OpenAI
+from openai import OpenAI, APIConnectionError, APITimeoutError
 import pandas as pd
+import Embedding_cache
+import Metrics
 
 load_dotenv()
 
-client     = OpenAI(
-    api_key= os.environ["OPENAI_KEY"],
-)
+#the client is made on first use, so importing this file doesn't need the key
+client       = None
+_client_lock = threading.Lock()
+
+def get_client():
+    global client
+    if client is None:
+        with _client_lock:
+            if client is None:
+                new_client = OpenAI(
+                    api_key= os.environ["OPENAI_KEY"],
+                )
+                #a client set while this one was made, e.g. a stub, is kept
+                if client is None:
+                    client = new_client
+    return client
 
 def get_embeddings(string : str, model = "text-embedding-3-small", save_to_file = None):
     '''
     This function tries to send a post request to OpenAI to make embeddings of a given string.
+    Strings that were embedded before are taken from the cache in Embedding_cache.py.
 
     Arguments:
     string      :        the string send to OpenAI
     model       :        (Optional) choose the model
-    save_to_file:        (Optional) save the full statement from OpenAI to given file
+    save_to_file:        (Optional) save the full statement from OpenAI to given file, this skips the cache lookup
 
     returns     :        the embeddings as a list
     '''   
-    embeddings = client.embeddings.create(input = [string], model=model)
+    cache = Embedding_cache.get_cache()
+    if not save_to_file:
+        with Metrics.span("embedding_cache"):
+            cached = cache.get(string, model=model)
+        if cached is not None:
+            return cached
+    with Metrics.span("embedding_api"):
+        embeddings = get_client().embeddings.create(input = [string], model=model)
     if save_to_file:
         with open(save_to_file, mode="w+") as fl:
             fl.write(f'{embeddings}')
+    cache.put(string, embeddings.data[0].embedding, model=model)
     return embeddings.data[0].embedding
 
-def get_embeddings_for_df(df : pd.DataFrame, model="text-embedding-3-small", save_to_file=None, col_name="quote"):
+#limits of a single embeddings request, the api allows up to 2048 inputs and 300000 tokens
+MAX_BATCH_SIZE  = 256
+MAX_BATCH_CHARS = 200_000
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+def is_retryable(error : Exception):
+    '''
+    Checks if a failed request is worth sending again, i.e. rate limits, server errors and network errors.
+    '''
+    if isinstance(error, (APIConnectionError, APITimeoutError)):
+        return True
+    return getattr(error, "status_code", None) in RETRY_STATUS
+
+def make_batches(strings : list, batch_size=MAX_BATCH_SIZE, max_chars=MAX_BATCH_CHARS):
+    '''
+    Splits the positions of the strings into batches that are bounded by the amount of strings and their total length.
+
+    Arguments:
+    strings     :        the strings meant for embedding
+    batch_size  :        (Optional) the max amount of strings in a batch
+    max_chars   :        (Optional) the max amount of characters in a batch
+
+    returns     :        list of lists of positions
+    '''
+    batches, batch, chars = [], [], 0
+    for i, string in enumerate(strings):
+        if batch and (len(batch) >= batch_size or chars + len(string) > max_chars):
+            batches.append(batch)
+            batch, chars = [], 0
+        batch.append(i)
+        chars += len(string)
+    if batch:
+        batches.append(batch)
+    return batches
+
+def get_embeddings_batch(strings : list, model="text-embedding-3-small", retries=5, backoff=1.0):
+    '''
+    This function sends one post request to OpenAI to make embeddings for several strings.
+    Rate limits and server errors are retried with exponential backoff.
+
+    Arguments:
+    strings     :        the strings send to OpenAI
+    model       :        (Optional) choose the model
+    retries     :        (Optional) how many times a failed request is retried
+    backoff     :        (Optional) seconds to wait before the first retry, doubled after every retry
+
+    returns     :        the embeddings as a list of lists in the same order as the strings
+    '''
+    for attempt in range(retries + 1):
+        try:
+            with Metrics.span("embedding_api"):
+                embeddings = get_client().embeddings.create(input=list(strings), model=model)
+            break
+        except Exception as error:
+            if attempt == retries or not is_retryable(error):
+                raise
+            time.sleep(backoff * 2**attempt * (1 + random.random()))
+    return [item.embedding for item in sorted(embeddings.data, key=lambda item: item.index)]
+
+def load_checkpoint(checkpoint : str, strings : list, model="text-embedding-3-small"):
+    '''
+    Reads the embeddings saved by an interrupted run of get_embeddings_bulk.
+    Lines whose string or model doesn't match the current input anymore are ignored.
+
+    Arguments:
+    checkpoint  :        path of the checkpoint file
+    strings     :        the strings meant for embedding
+    model       :        (Optional) the model of the current run
+
+    returns     :        dictionary of position -> embeddings
+    '''
+    done = {}
+    if not checkpoint or not os.path.exists(checkpoint):
+        return done
+    with open(checkpoint) as fl:
+        for line in fl:
+            try:
+                saved = json.loads(line)
+            except json.JSONDecodeError:
+                #the last line can be cut off when the run was killed
+                continue
+            i = saved["i"]
+            if i < len(strings) and strings[i] == saved["text"] and saved["model"] == model:
+                done[i] = saved["embedding"]
+    return done
+
+def get_embeddings_bulk(strings : list, model="text-embedding-3-small", batch_size=MAX_BATCH_SIZE, workers=4, checkpoint=None):
+    '''
+    This function makes embeddings for many strings, sending several batches to OpenAI at the same time.
+    Strings found in the cache of Embedding_cache.py are not sent again, so running it again over mostly
+    unchanged strings only embeds the new ones. With a checkpoint every finished batch is also appended
+    to the file, so an interrupted run can be started again and only embeds what is missing.
+
+    Arguments:
+    strings     :        the strings send to OpenAI
+    model       :        (Optional) choose the model
+    batch_size  :        (Optional) the max amount of strings in one request
+    workers     :        (Optional) the amount of requests sent at the same time
+    checkpoint  :        (Optional) path of a jsonl file used to save and resume the progress
+
+    returns     :        the embeddings as a list of lists in the same order as the strings
+    '''
+    strings = list(strings)
+    cache   = Embedding_cache.get_cache()
+    done    = load_checkpoint(checkpoint, strings, model=model)
+    missing = [i for i in range(len(strings)) if i not in done]
+    with Metrics.span("embedding_cache"):
+        cached = cache.get_many([strings[i] for i in missing], model=model)
+    done.update({missing[j]: emb for j, emb in cached.items()})
+    todo    = [i for i in range(len(strings)) if i not in done]
+    lock    = threading.Lock()
+
+    def embed(batch):
+        batch      = [todo[j] for j in batch]
+        embeddings = get_embeddings_batch([strings[i] for i in batch], model=model)
+        cache.put_many([strings[i] for i in batch], embeddings, model=model)
+        with lock:
+            for i, emb in zip(batch, embeddings):
+                done[i] = emb
+            if checkpoint:
+                with open(checkpoint, mode="a") as fl:
+                    for i, emb in zip(batch, embeddings):
+                        fl.write(json.dumps({"i": i, "text": strings[i], "model": model, "embedding": emb}) + "\n")
+
+    batches = make_batches([strings[i] for i in todo], batch_size=batch_size)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        #list() raises the first error of a batch that failed all its retries
+        list(pool.map(embed, batches))
+    return [done[i] for i in range(len(strings))]
+
+def get_embeddings_for_df(df : pd.DataFrame, model="text-embedding-3-small", save_to_file=None, col_name="quote", batch_size=MAX_BATCH_SIZE, workers=4, checkpoint=None):
     '''
-    This function tries to send a post request to OpenAI to make embeddings for a DataFrame object's column.
+    This function tries to send post requests to OpenAI to make embeddings for a DataFrame object's column.
+    The column is sent in batches, see get_embeddings_bulk.
 
     Arguments:
     df          :        the df that contains the text to embed
     model       :        (Optional) choose the model
     save_to_file:        (Optional) save the df to csv
     col_name    :        (Optional) the column name of the text meant for embedding 
+    batch_size  :        (Optional) the max amount of strings in one request
+    workers     :        (Optional) the amount of requests sent at the same time
+    checkpoint  :        (Optional) path of a jsonl file used to save and resume the progress
 
     returns     :        changes the original df
     '''   
-    df["embeddings"] = df[col_name].apply(lambda line: get_embeddings(line, model=model))
+    df["embeddings"] = get_embeddings_bulk(df[col_name].tolist(), model=model, batch_size=batch_size, workers=workers, checkpoint=checkpoint)
     if save_to_file:
         df.to_csv(save_to_file)
 
@@ -0,0 +1,100 @@
+###########################################################################
+#This file contains a holder for things that are slow to load             #
+#loaded on first use or in the background, and swapped when files change  #
+###########################################################################
+import os
+import time
+import threading
+
+RELOAD_INTERVAL = float(os.getenv("RELOAD_INTERVAL", "5"))
+
+class LazyResource:
+    '''
+    Loads a value the first time it is needed. When a watched file changes, the value is loaded again in
+    a background thread and swapped in once it is ready, the old value keeps serving until then.
+
+    Arguments:
+    load        :        function that loads the value
+    watch       :        (Optional) function that returns the path of the file to watch
+    interval    :        (Optional) seconds between two checks of the watched file
+    '''
+    def __init__(self, load, watch=None, interval=RELOAD_INTERVAL):
+        self.load       = load
+        self.watch      = watch
+        self.interval   = interval
+        self._value     = None
+        self._stamp     = None
+        self._checked   = 0.0
+        self._lock      = threading.Lock()
+        self._reloading = False
+
+    def _file_stamp(self):
+        if self.watch is None:
+            return None
+        try:
+            stat = os.stat(self.watch())
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    @property
+    def loaded(self):
+        return self._value
+
+    def get(self):
+        value = self._value
+        if value is None:
+            with self._lock:
+                if self._value is None:
+                    #take the stamp first, so a change during loading is picked up by the next check
+                    stamp         = self._file_stamp()
+                    self._value   = self.load()
+                    self._stamp   = stamp
+                    self._checked = time.monotonic()
+                return self._value
+        self._check()
+        return value
+
+    def set(self, value):
+        '''
+        Replaces the value, e.g. with a stand-in for benchmarks.
+        '''
+        with self._lock:
+            self._value   = value
+            self._stamp   = self._file_stamp()
+            self._checked = time.monotonic()
+
+    def warm(self):
+        '''
+        Starts loading in a background thread, so the first request doesn't have to wait for it.
+        '''
+        thread = threading.Thread(target=self.get, daemon=True)
+        thread.start()
+        return thread
+
+    def _check(self):
+        now = time.monotonic()
+        if self.watch is None or now - self._checked < self.interval:
+            return
+        #checked and set under the lock, so two requests never start two reloads
+        with self._lock:
+            if self._reloading or now - self._checked < self.interval:
+                return
+            self._checked = now
+            stamp         = self._file_stamp()
+            if stamp == self._stamp:
+                return
+            self._reloading = True
+        threading.Thread(target=self._reload, args=(stamp,), daemon=True).start()
+
+    def _reload(self, stamp):
+        try:
+            value = self.load()
+            with self._lock:
+                self._value, self._stamp = value, stamp
+        except Exception:
+            #keep serving the old value, the next check tries again
+            pass
+        finally:
+            with self._lock:
+                self._reloading = False
@@ -0,0 +1,241 @@
+###########################################################################
+#This file contains an inverted index with BM25 scoring over the quotes   #
+###########################################################################
+import re
+import math
+import bisect
+import unicodedata
+from collections import defaultdict
+import numpy as np
+import Quotes
+import Lazy_resource
+
+#weights of the fields in the score, a match in the quote counts more than one in the movie title
+FIELDS      = {"quote": 1.0, "movie": 0.5}
+K1          = 1.2
+B           = 0.75
+MAX_PREFIX  = 50
+
+def tokenize(text : str):
+    '''
+    Splits a text into lowercase words. Apostrophes are dropped, so "It's" and "its" are the same word.
+    '''
+    text = unicodedata.normalize("NFKC", str(text)).lower().replace("'", "").replace("’", "")
+    return re.findall(r"[^\W_]+", text)
+
+class LexicalIndex:
+    '''
+    Inverted index over the quote and movie of every row. Supports BM25 ranking, phrase and prefix matching,
+    and filters on type and year through bitmaps that are built once with the index.
+
+    Arguments:
+    rows        :        list of dictionaries with the keys quote, movie, type and year
+    '''
+    def __init__(self, rows):
+        self.rows     = list(rows)
+        self.size     = len(self.rows)
+        self.postings = {}
+        self.lengths  = {}
+        self.average  = {}
+        #positions of every word in the quotes, used for phrase matching
+        self.positions = defaultdict(dict)
+        for field in FIELDS:
+            postings = defaultdict(dict)
+            lengths  = np.zeros(self.size, dtype=np.float32)
+            for doc, row in enumerate(self.rows):
+                tokens        = tokenize(row.get(field) or "")
+                lengths[doc]  = len(tokens)
+                for position, token in enumerate(tokens):
+                    postings[token][doc] = postings[token].get(doc, 0) + 1
+                    if field == "quote":
+                        self.positions[token].setdefault(doc, []).append(position)
+            self.postings[field] = {
+                token: (np.fromiter(docs.keys(), dtype=np.int64), np.fromiter(docs.values(), dtype=np.float32))
+                for token, docs in postings.items()
+            }
+            self.lengths[field] = lengths
+            self.average[field] = float(lengths.mean()) if self.size else 0.0
+        self.vocabulary = sorted(set().union(*(postings.keys() for postings in self.postings.values())))
+        self.quote_tokens = [tokenize(row.get("quote") or "") for row in self.rows]
+
+        self.type_bitmaps = defaultdict(lambda: np.zeros(self.size, dtype=bool))
+        self.year_bitmaps = defaultdict(lambda: np.zeros(self.size, dtype=bool))
+        for doc, row in enumerate(self.rows):
+            self.type_bitmaps[str(row.get("type")).lower()][doc] = True
+            #missing years are NaN in the df
+            if row.get("year") is not None and row["year"] == row["year"]:
+                self.year_bitmaps[int(row["year"])][doc] = True
+        self.type_bitmaps = dict(self.type_bitmaps)
+        self.year_bitmaps = dict(self.year_bitmaps)
+
+    def __len__(self):
+        return self.size
+
+    def mask(self, type=None, year=None):
+        '''
+        Combines the precomputed bitmaps of the filters.
+
+        Arguments:
+        type        :        (Optional) the type of the rows, e.g. "movie" or "tv"
+        year        :        (Optional) a year, or a (first, last) tuple for a range of years
+
+        returns     :        a boolean array with True for the rows that pass, None without filters
+        '''
+        if type is None and year is None:
+            return None
+        mask = np.ones(self.size, dtype=bool)
+        if type is not None:
+            mask &= self.type_bitmaps.get(str(type).lower(), np.zeros(self.size, dtype=bool))
+        if year is not None:
+            first, last = year if isinstance(year, tuple) else (year, year)
+            years       = np.zeros(self.size, dtype=bool)
+            for y, bitmap in self.year_bitmaps.items():
+                if first <= y <= last:
+                    years |= bitmap
+            mask &= years
+        return mask
+
+    def expand(self, token, prefix=False):
+        '''
+        Returns the words of the index a query word stands for: itself, or with prefix every word starting with it.
+        '''
+        if not prefix:
+            return [token]
+        start = bisect.bisect_left(self.vocabulary, token)
+        words = []
+        for word in self.vocabulary[start:start + MAX_PREFIX]:
+            if not word.startswith(token):
+                break
+            words.append(word)
+        return words
+
+    def phrase_docs(self, tokens, mask=None):
+        '''
+        Finds the rows whose quote contains the words right after each other.
+
+        Arguments:
+        tokens      :        the words of the phrase
+        mask        :        (Optional) boolean array of the rows to consider
+
+        returns     :        list of row positions
+        '''
+        if not tokens or any(token not in self.positions for token in tokens):
+            return []
+        docs = set(self.positions[tokens[0]])
+        for token in tokens[1:]:
+            docs &= set(self.positions[token])
+        found = []
+        for doc in sorted(docs):
+            if mask is not None and not mask[doc]:
+                continue
+            starts = set(self.positions[tokens[0]][doc])
+            for offset, token in enumerate(tokens[1:], start=1):
+                starts &= {position - offset for position in self.positions[token][doc]}
+            if starts:
+                found.append(doc)
+        return found
+
+    def scores(self, query, mask=None, prefix=False):
+        '''
+        BM25 scores of every row for a query. Rows filtered out by the mask are never scored.
+
+        Arguments:
+        query       :        the query string
+        mask        :        (Optional) boolean array of the rows to consider
+        prefix      :        (Optional) treat the last query word as the start of a word
+
+        returns     :        array with a score for every row
+        '''
+        scores = np.zeros(self.size, dtype=np.float32)
+        tokens = tokenize(query)
+        for i, token in enumerate(tokens):
+            for word in self.expand(token, prefix=prefix and i == len(tokens) - 1):
+                for field, weight in FIELDS.items():
+                    if word not in self.postings[field]:
+                        continue
+                    docs, tfs = self.postings[field][word]
+                    idf       = math.log(1 + (self.size - len(docs) + 0.5) / (len(docs) + 0.5))
+                    if mask is not None:
+                        keep      = mask[docs]
+                        docs, tfs = docs[keep], tfs[keep]
+                    norm          = K1 * (1 - B + B * self.lengths[field][docs] / (self.average[field] or 1))
+                    scores[docs] += weight * idf * tfs * (K1 + 1) / (tfs + norm)
+        return scores
+
+    def search(self, query, limit=3, mask=None, phrase=False, prefix=False):
+        '''
+        Ranks the rows for a query with BM25.
+
+        Arguments:
+        query       :        the query string
+        limit       :        (Optional) the amount of rows returned
+        mask        :        (Optional) boolean array of the rows to consider, see mask()
+        phrase      :        (Optional) only return rows whose quote contains the query as a phrase
+        prefix      :        (Optional) treat the last query word as the start of a word
+
+        returns     :        list of (row position, score), best first
+        '''
+        scores = self.scores(query, mask=mask, prefix=prefix)
+        if phrase:
+            allowed = np.zeros(self.size, dtype=bool)
+            allowed[self.phrase_docs(tokenize(query), mask=mask)] = True
+            scores[~allowed] = 0
+        candidates = np.flatnonzero(scores > 0)
+        best       = candidates[np.argsort(-scores[candidates], kind="stable")][:limit]
+        return [(int(doc), float(scores[doc])) for doc in best]
+
+    def exact_hits(self, query, limit=3, mask=None, min_words=2, min_coverage=0.5):
+        '''
+        Finds quotes that contain the query word for word and are mostly made of it, e.g. "there is no try".
+        These are confident enough to be returned without a semantic search.
+
+        Arguments:
+        query       :        the query string
+        limit       :        (Optional) the amount of rows returned
+        mask        :        (Optional) boolean array of the rows to consider
+        min_words   :        (Optional) shorter queries are never treated as exact hits
+        min_coverage:        (Optional) the part of the quote's words the query has to cover
+
+        returns     :        list of (row position, score), best first, empty when there is no confident hit
+        '''
+        tokens = tokenize(query)
+        if len(tokens) < min_words:
+            return []
+        docs = [doc for doc in self.phrase_docs(tokens, mask=mask) if len(tokens) / max(1, len(self.quote_tokens[doc])) >= min_coverage]
+        if not docs:
+            return []
+        scores = self.scores(query, mask=mask)
+        docs.sort(key=lambda doc: -scores[doc])
+        return [(doc, float(scores[doc])) for doc in docs[:limit]]
+
+    def row(self, doc, score):
+        return {"QUOTE": self.rows[doc]["quote"], "MOVIE": self.rows[doc]["movie"], "SCORE": score}
+
+def reciprocal_rank_fusion(result_lists, limit=3, k=60):
+    '''
+    Merges ranked result lists: every result gets 1/(k + rank) from each list it is in.
+
+    Arguments:
+    result_lists:        lists of result dictionaries with QUOTE and MOVIE, best first
+    limit       :        (Optional) the amount of results returned
+    k           :        (Optional) damps the weight of the top ranks
+
+    returns     :        the merged results, SCORE is the fused score
+    '''
+    fused = {}
+    for results in result_lists:
+        for rank, result in enumerate(results, start=1):
+            key = (result["QUOTE"], result["MOVIE"])
+            if key not in fused:
+                fused[key] = {"QUOTE": result["QUOTE"], "MOVIE": result["MOVIE"], "SCORE": 0.0}
+            fused[key]["SCORE"] += 1 / (k + rank)
+    return sorted(fused.values(), key=lambda result: -result["SCORE"])[:limit]
+
+def load_index():
+    return LexicalIndex(Quotes.load_quotes().to_dict("records"))
+
+#built on first use, and built again when data.json changes
+index = Lazy_resource.LazyResource(load_index, watch=lambda: Quotes.DATA_PATH)
+
+def get_index():
+    return index.get()
@@ -0,0 +1,246 @@
+###########################################################################
+#This file contains an in-process search engine for the quote embeddings  #
+###########################################################################
+import os
+import json
+import numpy as np
+import pandas as pd
+import Embeddings
+import Metrics
+import Vector_store
+import Ann_index
+import Lazy_resource
+from Ann_index import normalize, top_k
+
+CORPUS_PATH = os.getenv("LOCAL_CORPUS", "embeddings.csv")
+INDEX       = os.getenv("SEARCH_INDEX", "exact").lower()
+NPROBE      = int(os.getenv("IVF_NPROBE", "8"))
+EF          = int(os.getenv("HNSW_EF", "50"))
+
+class LocalSearch:
+    '''
+    Keeps the quote embeddings in memory as one pre-normalized float32 matrix.
+    The default exact index makes a search a single matrix-vector product, see Ann_index.py for the others.
+
+    Arguments:
+    vectors     :        2d array with one embedding per quote
+    quotes      :        list of quotes in the same order as vectors
+    movies      :        list of movies in the same order as vectors
+    normalized  :        (Optional) the vectors already have unit length, they are used without a copy
+    index       :        (Optional) a nearest neighbour index built from the same vectors, exact by default
+    deleted     :        (Optional) positions of quotes that were removed from the corpus and are never returned
+    types       :        (Optional) list of types in the same order as vectors, needed to filter on type
+    years       :        (Optional) list of years in the same order as vectors, needed to filter on year
+    '''
+    def __init__(self, vectors, quotes, movies, normalized=False, index=None, deleted=(), types=None, years=None):
+        self.vectors = vectors if normalized else normalize(vectors)
+        self.quotes  = list(quotes)
+        self.movies  = list(movies)
+        self.index   = index or Ann_index.ExactIndex(self.vectors)
+        self.deleted = np.zeros(len(self.quotes), dtype=bool)
+        self.deleted[list(deleted)] = True
+        self.removed = int(self.deleted.sum())
+        #missing types and years never pass a filter
+        types        = types if types is not None else [None] * len(self.quotes)
+        years        = years if years is not None else [None] * len(self.quotes)
+        self.types   = np.array(["" if pd.isna(t) else str(t).lower() for t in types], dtype=str)
+        self.years   = np.array([np.nan if pd.isna(y) else float(y) for y in years], dtype=np.float64)
+
+    @classmethod
+    def from_csv(cls, path=CORPUS_PATH, col_name="embeddings"):
+        '''
+        Builds the engine from the csv made by Quotes.py. The embeddings are parsed once here
+        instead of on every comparison.
+
+        Arguments:
+        path        :        (Optional) the csv file with the embeddings
+        col_name    :        (Optional) the column name of the embeddings
+
+        returns     :        LocalSearch
+        '''
+        df      = pd.read_csv(path)
+        vectors = np.array([json.loads(emb) for emb in df[col_name]], dtype=np.float32)
+        return cls(vectors, df["quote"], df["movie"], types=df.get("type"), years=df.get("year"))
+
+    @classmethod
+    def from_store(cls, path=Vector_store.STORE_PATH):
+        '''
+        Builds the engine from the binary store made by Quotes.py. The vectors stay memory mapped.
+
+        Arguments:
+        path        :        (Optional) the path of the store without the file extension
+
+        returns     :        LocalSearch
+        '''
+        vectors, meta = Vector_store.load_store(path)
+        rows          = meta["rows"]
+        return cls(
+            vectors, [row["quote"] for row in rows], [row["movie"] for row in rows], normalized=meta["normalized"], deleted=meta.get("deleted", []),
+            types=[row.get("type") for row in rows], years=[row.get("year") for row in rows],
+        )
+
+    def __len__(self):
+        return len(self.quotes) - self.removed
+
+    def _rows(self, positions, scores, limit):
+        #deleted quotes stay in the index, so they are skipped here
+        found = [self.row(i, score) for i, score in zip(positions, scores) if not self.deleted[i]]
+        return found[:limit]
+
+    def mask(self, type=None, year=None):
+        '''
+        Arguments:
+        type        :        (Optional) the type of the quotes, e.g. "movie" or "tv"
+        year        :        (Optional) a year, or a (first, last) tuple for a range of years
+
+        returns     :        a boolean array with True for the quotes that pass, None without filters
+        '''
+        if type is None and year is None:
+            return None
+        mask = ~self.deleted
+        if type is not None:
+            mask &= self.types == str(type).lower()
+        if year is not None:
+            first, last = year if isinstance(year, tuple) else (year, year)
+            mask &= (self.years >= first) & (self.years <= last)
+        return mask
+
+    def search(self, vector, limit=3, type=None, year=None):
+        '''
+        Returns the quotes closest to a vector. With a filter only the quotes that pass it are scored,
+        with the exact scan, so a narrow filter still returns its best quotes.
+
+        Arguments:
+        vector      :        the embeddings of the query as a list
+        limit       :        (Optional) the amount of quotes that the function returns
+        type        :        (Optional) only return quotes of this type
+        year        :        (Optional) only return quotes of this year, or a (first, last) tuple of years
+
+        returns     :        quotes, movies and cosine similarity as a list of dictionares
+        '''
+        query = normalize(np.asarray(vector, dtype=np.float32))
+        mask  = self.mask(type=type, year=year)
+        if mask is not None:
+            positions = np.flatnonzero(mask)
+            scores    = self.vectors[positions] @ query
+            best      = top_k(scores, limit)
+            return self._rows(positions[best], scores[best], limit)
+        positions, scores = self.index.search(query, limit + self.removed)
+        return self._rows(positions, scores, limit)
+
+    def search_many(self, vectors, limit=3):
+        '''
+        Returns the quotes closest to each of several vectors, scored together.
+
+        Arguments:
+        vectors     :        the embeddings of the queries as a list of lists
+        limit       :        (Optional) the amount of quotes returned per query
+
+        returns     :        a list with the results of every query, in the same order as vectors
+        '''
+        if len(vectors) == 0:
+            return []
+        queries = normalize(np.asarray(vectors, dtype=np.float32))
+        return [self._rows(positions, scores, limit) for positions, scores in self.index.search_many(queries, limit + self.removed)]
+
+    def row(self, i, score):
+        return {"QUOTE": self.quotes[i], "MOVIE": self.movies[i], "SCORE": float(score)}
+
+def load_engine():
+    '''
+    Loads the engine. The binary store is used when it exists, otherwise the embeddings.csv.
+    The index is picked with the SEARCH_INDEX env variable.
+
+    returns     :        LocalSearch
+    '''
+    if Vector_store.exists():
+        engine = LocalSearch.from_store()
+    else:
+        engine = LocalSearch.from_csv(CORPUS_PATH)
+    engine.index = get_index(engine.vectors)
+    return engine
+
+#loaded on first use, and loaded again when Quotes.py updates the store
+engine = Lazy_resource.LazyResource(load_engine, watch=lambda: Vector_store.meta_path())
+
+def get_engine():
+    return engine.get()
+
+def warm_up():
+    '''
+    Loads the engine and the OpenAI client, so the first search doesn't wait for them.
+    The engine comes first, it doesn't need the OpenAI key.
+    '''
+    get_engine()
+    Embeddings.get_client()
+
+def available():
+    '''
+    returns     :        True when the engine is loaded or there is a store or csv to load it from
+    '''
+    return engine.loaded is not None or Vector_store.exists() or os.path.exists(CORPUS_PATH)
+
+def corpus_size():
+    '''
+    returns     :        the amount of quotes in the engine, None when it isn't loaded yet
+    '''
+    return len(engine.loaded) if engine.loaded is not None else None
+
+def index_path(kind=INDEX, path=Vector_store.STORE_PATH):
+    return f"{path}.{kind}.npz"
+
+def get_index(vectors, kind=INDEX):
+    '''
+    Loads the index saved next to the store by Quotes.py, or builds it when there is none.
+
+    Arguments:
+    vectors     :        the unit length vectors of the engine
+    kind        :        (Optional) "exact", "ivf" or "hnsw"
+
+    returns     :        the index
+    '''
+    index = None
+    if kind != "exact" and os.path.exists(index_path(kind)):
+        try:
+            index = Ann_index.load_index(index_path(kind), vectors)
+        except ValueError:
+            #the index is from an older store, build a new one
+            index = None
+    if index is None:
+        index = Ann_index.build_index(kind, vectors)
+    if kind == "ivf":
+        index.nprobe = NPROBE
+    if kind == "hnsw":
+        index.ef = EF
+    return index
+
+def search_query(query, limit=3, type=None, year=None):
+    search_item = Embeddings.get_embeddings(query)
+    with Metrics.span("vector_search"):
+        return get_engine().search(search_item, limit, type=type, year=year)
+
+def search_many(queries, k=3):
+    '''
+    Searches many queries at once: they are embedded in batched requests and scored together.
+
+    Arguments:
+    queries     :        list of query strings
+    k           :        (Optional) the amount of quotes returned per query
+
+    returns     :        a list with the results of every query, in the same order as queries
+    '''
+    vectors = Embeddings.get_embeddings_bulk(queries)
+    with Metrics.span("vector_search"):
+        return get_engine().search_many(vectors, k)
+
+def do_embedding_search(search_df, limit=3):
+    '''
+    Same as Snowflake_tools.do_embedding_search, but searches the in-memory matrix.
+
+    Arguments:
+    search_df:   the embeddings as a df with the column EMBD.
+    limit:       the amount of quotes that the function returns.
+
+    Retruns:     quotes, movies and cosine similarity as a list of dictionares.
+    '''
+    return get_engine().search(search_df["EMBD"].iloc[0], limit)
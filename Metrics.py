@@ -0,0 +1,200 @@
+###########################################################################
+#This file contains the latency metrics of the search path                #
+#timed with span(stage) and exposed in the prometheus text format         #
+###########################################################################
+import os
+import sys
+import time
+import threading
+from bisect import bisect_left
+from collections import defaultdict, deque, Counter
+from contextlib import contextmanager
+
+#upper bounds in seconds of the histogram buckets
+BUCKETS   = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUANTILES = (0.5, 0.95, 0.99)
+#the percentiles are computed from the latest samples of every stage
+RESERVOIR = 2048
+
+class Histogram:
+    '''
+    Counts durations in buckets like a prometheus histogram and keeps the latest samples for percentiles.
+    '''
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count   = 0
+        self.sum     = 0.0
+        self.samples = deque(maxlen=RESERVOIR)
+
+    def observe(self, seconds):
+        i = bisect_left(BUCKETS, seconds)
+        if i < len(BUCKETS):
+            self.buckets[i] += 1
+        self.count += 1
+        self.sum   += seconds
+        self.samples.append(seconds)
+
+    def quantile(self, q):
+        if not self.samples:
+            return 0.0
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+class Registry:
+    '''
+    Holds the stage histograms, counters and gauges of the process.
+    '''
+    def __init__(self):
+        self.stages   = defaultdict(Histogram)
+        self.counters = Counter()
+        self.gauges   = {}
+        #counters kept somewhere else, e.g. by the embedding cache, read like the gauges
+        self.external = {}
+        self._lock    = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            self.stages[stage].observe(seconds)
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def gauge(self, name, help, function):
+        '''
+        Registers a value that is read when the metrics are rendered, e.g. the size of the corpus.
+
+        Arguments:
+        name        :        the metric name
+        help        :        the description shown in /metrics
+        function    :        returns the current value, or None when it isn't known yet
+        '''
+        self.gauges[name] = (help, function)
+
+    def counter(self, name, help, function):
+        '''
+        Registers a counter that is kept somewhere else and read when the metrics are rendered.
+
+        Arguments:
+        name        :        the metric name, ending in _total
+        help        :        the description shown in /metrics
+        function    :        returns the current value, or None when it isn't known yet
+        '''
+        self.external[name] = (help, function)
+
+    def snapshot(self):
+        '''
+        returns     :        dictionary of stage -> count, mean and percentiles in seconds
+        '''
+        with self._lock:
+            return {
+                stage: {
+                    "count": hist.count,
+                    "mean" : hist.sum / hist.count if hist.count else 0.0,
+                    **{f"p{int(q * 100)}": hist.quantile(q) for q in QUANTILES},
+                }
+                for stage, hist in self.stages.items()
+            }
+
+    def render(self):
+        '''
+        returns     :        all metrics in the prometheus text format
+        '''
+        lines = []
+        with self._lock:
+            stages   = {stage: (list(hist.buckets), hist.count, hist.sum, [hist.quantile(q) for q in QUANTILES]) for stage, hist in self.stages.items()}
+            counters = dict(self.counters)
+
+        lines += ["# HELP search_stage_duration_seconds Time spent in every stage of the search path.",
+                  "# TYPE search_stage_duration_seconds histogram"]
+        for stage, (buckets, count, total, _) in sorted(stages.items()):
+            cumulative = 0
+            for bound, amount in zip(BUCKETS, buckets):
+                cumulative += amount
+                lines.append(f'search_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'search_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}')
+            lines.append(f'search_stage_duration_seconds_sum{{stage="{stage}"}} {total}')
+            lines.append(f'search_stage_duration_seconds_count{{stage="{stage}"}} {count}')
+
+        lines += ["# HELP search_stage_latency_seconds Percentiles of the latest samples of every stage.",
+                  "# TYPE search_stage_latency_seconds summary"]
+        for stage, (_, count, total, quantiles) in sorted(stages.items()):
+            for q, value in zip(QUANTILES, quantiles):
+                lines.append(f'search_stage_latency_seconds{{stage="{stage}",quantile="{q}"}} {value}')
+            lines.append(f'search_stage_latency_seconds_sum{{stage="{stage}"}} {total}')
+            lines.append(f'search_stage_latency_seconds_count{{stage="{stage}"}} {count}')
+
+        for name, value in sorted(counters.items()):
+            lines += [f"# TYPE {name} counter", f"{name} {value}"]
+
+        for kind, functions in [("counter", self.external), ("gauge", self.gauges)]:
+            for name, (help, function) in sorted(functions.items()):
+                value = function()
+                if value is None:
+                    continue
+                lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self.stages.clear()
+            self.counters.clear()
+
+registry = Registry()
+
+@contextmanager
+def span(stage):
+    '''
+    Times the block and records it under the stage name.
+
+    Arguments:
+    stage       :        the name of the stage, e.g. "embedding_api"
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe(stage, time.perf_counter() - start)
+
+class SamplingProfiler:
+    '''
+    Looks at the stacks of all threads every interval seconds and counts them. The result is in the
+    collapsed stack format that flamegraph tools read. It costs a little cpu, so it only runs when turned on.
+
+    Arguments:
+    interval    :        (Optional) seconds between samples
+    '''
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.stacks   = Counter()
+        self._stop    = threading.Event()
+        self._thread  = None
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def collapsed(self):
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common()) + "\n"
+
+profiler = SamplingProfiler(float(os.getenv("PROFILE_INTERVAL", "0.01"))) if os.getenv("PROFILE_SAMPLING") == "1" else None
@@ -1,13 +1,105 @@
 ################################################################################################
-#The main of this file creates the embeddings.csv                                              #
-#Running this file may take a few minutes                                                      #
+#The main of this file creates the embeddings.csv and the binary store embeddings.npy          #
+#When the store exists, only the quotes that changed in data.json are embedded                 #
+#Run with --full to make everything again, this may take a few minutes                         #
 ################################################################################################
 
+import os
+import sys
+from collections import defaultdict
 import pandas as pd
 import Embeddings
+import Vector_store
+import Ann_index
+import Local_search
 
-quotes_df = pd.read_json("data.json")
+DATA_PATH = os.getenv("QUOTES_DATA", "data.json")
+MODEL     = "text-embedding-3-small"
 
+def load_quotes(path=DATA_PATH):
+    return pd.read_json(path)
+
+quotes_df = load_quotes()
+
+def save_index(vectors, path=Vector_store.STORE_PATH, kind=Local_search.INDEX, old_count=None):
+    '''
+    Saves the nearest neighbour index next to the store. With old_count the saved index of the first
+    old_count vectors is extended with the new ones instead of building it again. Call it before the
+    store is written: the apps reload when the store's metadata changes and then find the matching index.
+
+    Arguments:
+    vectors     :        the normalized vectors the store is about to get
+    path        :        (Optional) the path of the store without the file extension
+    kind        :        (Optional) "exact", "ivf" or "hnsw", nothing is saved for exact
+    old_count   :        (Optional) the amount of vectors in the store before the update
+    '''
+    if kind == "exact":
+        return
+    index_path = Local_search.index_path(kind, path)
+    index      = None
+    if old_count is not None and os.path.exists(index_path):
+        try:
+            index = Ann_index.load_index(index_path, vectors[:old_count])
+            index.extend(vectors)
+        except ValueError:
+            index = None
+    if index is None:
+        index = Ann_index.build_index(kind, vectors)
+    index.save(index_path)
+
+def build_corpus(df=quotes_df, path=Vector_store.STORE_PATH):
+    '''
+    Embeds every quote and makes the embeddings.csv, the store and the index from scratch.
+    '''
+    Embeddings.get_embeddings_for_df(df=df,save_to_file="embeddings.csv",checkpoint="embeddings.checkpoint.jsonl")
+    vectors, meta = Vector_store.make_store(df, model=MODEL)
+    save_index(vectors, path)
+    Vector_store.write_store(vectors, meta, path)
+
+def update_corpus(df=None, path=Vector_store.STORE_PATH):
+    '''
+    Compares the quotes with the store by content hash. Only added or changed quotes are embedded and
+    appended, removed or changed quotes are marked as deleted. Running apps pick the new store up by themselves.
+
+    Arguments:
+    df          :        (Optional) the quotes, read from data.json by default
+    path        :        (Optional) the path of the store without the file extension
+
+    returns     :        the amount of added and deleted quotes
+    '''
+    df            = load_quotes() if df is None else df
+    vectors, meta = Vector_store.load_store(path)
+    deleted       = set(meta.get("deleted", []))
+
+    #positions of the live rows of the store by hash, a list because data.json can contain the same quote twice.
+    #the hash is computed again from the row, so stores written by an older row_hash still match
+    stored = defaultdict(list)
+    for i, row in enumerate(meta["rows"]):
+        if i not in deleted:
+            stored[Vector_store.row_hash(row)].append(i)
+
+    added = []
+    for position, row in zip(df.index, df.to_dict("records")):
+        positions = stored.get(Vector_store.row_hash(row))
+        if positions:
+            positions.pop()
+        else:
+            added.append(position)
+    removed = [i for positions in stored.values() for i in positions]
+
+    if not added and not removed:
+        return 0, 0
+    new_df = df.loc[added].copy()
+    if len(new_df):
+        Embeddings.get_embeddings_for_df(df=new_df, model=MODEL)
+    new_vectors, new_meta = Vector_store.extend_store(new_df, deleted=removed, path=path, model=MODEL)
+    save_index(new_vectors, path, old_count=len(vectors))
+    Vector_store.write_store(new_vectors, new_meta, path)
+    return len(added), len(removed)
 
 if __name__=="__main__":
-    Embeddings.get_embeddings_for_df(df=quotes_df,save_to_file="embeddings.csv")
+    if "--full" in sys.argv or not Vector_store.exists():
+        build_corpus()
+    else:
+        added, deleted = update_corpus()
+        print(f"{added} quotes added, {deleted} quotes deleted")
@@ -0,0 +1,122 @@
+###########################################################################
+#This file picks the search backend used by the app                       #
+###########################################################################
+import os
+import logging
+import importlib
+from dotenv import load_dotenv
+import Lexical_index
+import Metrics
+
+load_dotenv()
+
+BACKENDS = {
+    "local"    : "Local_search",
+    "snowflake": "Snowflake_tools",
+}
+
+#without SEARCH_BACKEND the local backend is used when there is a local corpus, see default_backend()
+BACKEND = os.getenv("SEARCH_BACKEND", "").lower() or None
+
+logger  = logging.getLogger(__name__)
+_warned = False
+
+#semantic: only the embeddings, lexical: only BM25, hybrid: both merged with reciprocal rank fusion
+MODES      = ("semantic", "lexical", "hybrid")
+MODE       = os.getenv("SEARCH_MODE", "hybrid").lower()
+#the amount of results each side contributes to the fusion
+CANDIDATES = 50
+#what SCORE means for every way a result can be ranked, returned as SCORE_KIND with the results
+SCORE_KINDS = {"semantic": "cosine", "lexical": "bm25", "hybrid": "rrf"}
+
+def default_backend():
+    '''
+    The backend used when SEARCH_BACKEND isn't set: local when Quotes.py made a corpus for it,
+    otherwise snowflake, e.g. on a fresh deploy that doesn't ship embeddings.npy or embeddings.csv.
+    '''
+    global _warned
+    if importlib.import_module(BACKENDS["local"]).available():
+        return "local"
+    if not _warned:
+        _warned = True
+        logger.warning("There is no local corpus, searching with the snowflake backend. Run Quotes.py to make one.")
+    return "snowflake"
+
+def get_backend(name=None):
+    '''
+    Imports the module of a search backend. The snowflake backend is only imported when it is
+    picked, so the local backend runs without a warehouse or snowflake credentials.
+
+    Arguments:
+    name        :        (Optional) "local" or "snowflake", defaults to the SEARCH_BACKEND env variable, see default_backend()
+
+    returns     :        the backend module
+    '''
+    name = (name or BACKEND or default_backend()).lower()
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown search backend {name!r}, choose from {sorted(BACKENDS)}")
+    return importlib.import_module(BACKENDS[name])
+
+def warm_up():
+    '''
+    Loads the keyword index and the search backend, so the first search doesn't wait for them.
+    Each one is loaded even when the other fails, the first error is raised at the end.
+    '''
+    errors = []
+    for load in (Lexical_index.get_index, lambda: get_backend().warm_up()):
+        try:
+            load()
+        except Exception as error:
+            errors.append(error)
+    if errors:
+        raise errors[0]
+
+def labelled(results, kind):
+    return [{**result, "SCORE_KIND": kind} for result in results]
+
+def search_query(query, limit=3, mode=None, type=None, year=None):
+    '''
+    Searches the quotes. In the lexical and hybrid modes quotes that contain the query word for word
+    are returned right away, without calling the embedding model. The scores of the modes aren't
+    comparable, so every result says in SCORE_KIND whether SCORE is a cosine, bm25 or rrf score.
+
+    Arguments:
+    query       :        the query string
+    limit       :        (Optional) the amount of quotes that the function returns
+    mode        :        (Optional) "semantic", "lexical" or "hybrid", defaults to the SEARCH_MODE env variable
+    type        :        (Optional) only return quotes of this type, e.g. "movie" or "tv"
+    year        :        (Optional) only return quotes of this year, or a (first, last) tuple of years
+
+    returns     :        quotes, movies, scores and score kinds as a list of dictionares
+    '''
+    mode = (mode or MODE).lower()
+    if mode not in MODES:
+        raise ValueError(f"Unknown search mode {mode!r}, choose from {MODES}")
+    if mode == "semantic":
+        #the backends apply the filters before ranking, so a narrow filter still gets its best quotes
+        return labelled(get_backend().search_query(query, limit, type=type, year=year), SCORE_KINDS["semantic"])
+
+    lexical = Lexical_index.get_index()
+    mask    = lexical.mask(type=type, year=year)
+    with Metrics.span("lexical_exact"):
+        hits = lexical.exact_hits(query, limit, mask=mask)
+    if hits:
+        Metrics.registry.count("search_fast_path_total")
+        found = {doc for doc, score in hits}
+        rest  = [(doc, score) for doc, score in lexical.search(query, limit + len(hits), mask=mask) if doc not in found]
+        return labelled([lexical.row(doc, score) for doc, score in (hits + rest)[:limit]], SCORE_KINDS["lexical"])
+    if mode == "lexical":
+        with Metrics.span("lexical_search"):
+            return labelled([lexical.row(doc, score) for doc, score in lexical.search(query, limit, mask=mask, prefix=True)], SCORE_KINDS["lexical"])
+
+    semantic = get_backend().search_query(query, CANDIDATES, type=type, year=year)
+    with Metrics.span("lexical_search"):
+        keywords = [lexical.row(doc, score) for doc, score in lexical.search(query, CANDIDATES, mask=mask, prefix=True)]
+    with Metrics.span("fusion"):
+        return labelled(Lexical_index.reciprocal_rank_fusion([semantic, keywords], limit), SCORE_KINDS["hybrid"])
+
+def do_embedding_search(search_df, limit=3):
+    return get_backend().do_embedding_search(search_df, limit)
+
+def search_many(queries, k=3):
+    return [labelled(results, SCORE_KINDS["semantic"]) for results in get_backend().search_many(queries, k)]
@@ -4,33 +4,129 @@
 
 import snowflake.connector
 import os
+import json
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from snowflake.connector import DictCursor
 import pandas as pd
 from snowflake.connector.pandas_tools import write_pandas
 import Embeddings
+import Metrics
 
 def remove_quotes(string : str):
     return string.strip('\"')
 
+#missing settings only fail when the first connection is opened, not on import
 load_dotenv()
-PASSWORD  = remove_quotes(os.getenv('SNOWSQL_PWD'))
-WAREHOUSE = remove_quotes(os.getenv('WAREHOUSE'))
-ACCOUNT   = remove_quotes(os.getenv("SNOWSQL_ACC"))
-USER      = remove_quotes(os.getenv("SNOWSQL_USR"))
-DATABASE  = remove_quotes(os.getenv("SNOWSQL_DB"))
-SCHEMA    = remove_quotes(os.getenv("SNOWSQL_SCHEMA"))
-
-conn = snowflake.connector.connect(
-    user      = USER,
-    password  = PASSWORD,
-    account   = ACCOUNT,
-    warehouse = WAREHOUSE,
-    database  = DATABASE,
-    schema    = SCHEMA,
-)
-
-cur = conn.cursor(DictCursor)
+PASSWORD  = remove_quotes(os.getenv('SNOWSQL_PWD', ""))
+WAREHOUSE = remove_quotes(os.getenv('WAREHOUSE', ""))
+ACCOUNT   = remove_quotes(os.getenv("SNOWSQL_ACC", ""))
+USER      = remove_quotes(os.getenv("SNOWSQL_USR", ""))
+DATABASE  = remove_quotes(os.getenv("SNOWSQL_DB", ""))
+SCHEMA    = remove_quotes(os.getenv("SNOWSQL_SCHEMA", ""))
+POOL_SIZE = int(os.getenv("SNOWFLAKE_POOL_SIZE", "4"))
+
+def connect():
+    return snowflake.connector.connect(
+        user      = USER,
+        password  = PASSWORD,
+        account   = ACCOUNT,
+        warehouse = WAREHOUSE,
+        database  = DATABASE,
+        schema    = SCHEMA,
+    )
+
+class ConnectionPool:
+    '''
+    Hands out connections so every request gets one for itself. Connections are opened when they
+    are first needed, at most size of them, and a request waits when all of them are in use.
+
+    Arguments:
+    factory     :        function that opens a new connection
+    size        :        (Optional) the max amount of open connections
+    '''
+    def __init__(self, factory=connect, size=POOL_SIZE):
+        self.factory    = factory
+        self.size       = size
+        #idle connections, the last released one is handed out first
+        self._idle      = []
+        self._opened    = 0
+        #notified whenever a connection is released or closed, so a waiting request can take it or open a new one
+        self._available = threading.Condition()
+
+    def _acquire(self):
+        with self._available:
+            while not self._idle and self._opened >= self.size:
+                self._available.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._opened += 1
+        try:
+            return self.factory()
+        except Exception:
+            with self._available:
+                self._opened -= 1
+                self._available.notify()
+            raise
+
+    def _release(self, conn):
+        with self._available:
+            if conn.is_closed():
+                self._opened -= 1
+            else:
+                self._idle.append(conn)
+            self._available.notify()
+
+    @contextmanager
+    def connection(self):
+        '''
+        A connection that nobody else is using. When the block raises, e.g. because the network or
+        the session failed, the connection is closed instead of handed to the next request.
+        '''
+        conn = self._acquire()
+        try:
+            yield conn
+        except Exception:
+            try:
+                conn.close()
+            except Exception:
+                pass
+            raise
+        finally:
+            self._release(conn)
+
+    @contextmanager
+    def cursor(self):
+        '''
+        A DictCursor on a connection that nobody else is using, closed when the block ends.
+        '''
+        with self.connection() as conn:
+            cur = conn.cursor(DictCursor)
+            try:
+                yield cur
+            finally:
+                cur.close()
+
+    def close(self):
+        with self._available:
+            idle, self._idle  = self._idle, []
+            self._opened     -= len(idle)
+            self._available.notify_all()
+        for conn in idle:
+            conn.close()
+
+pool = ConnectionPool(connect, size=POOL_SIZE)
+
+def warm_up():
+    '''
+    Opens the first pooled connection and the OpenAI client, so the first search doesn't wait for them.
+    The connection comes first, it doesn't need the OpenAI key.
+    '''
+    with pool.connection():
+        pass
+    Embeddings.get_client()
 
 def to_df(emb_ls):
     '''
@@ -43,11 +139,28 @@ def to_df(emb_ls):
     '''
     return pd.DataFrame(data=[[emb_ls]], columns=["EMBD"])
 
-def search_query(query):
+def search_query(query, limit=3, type=None, year=None):
+    if type is not None or year is not None:
+        return get_closest_embeddings(Embeddings.get_embeddings(query), limit, type=type, year=year)
     search_item = to_df(Embeddings.get_embeddings(query))
-    results     = do_embedding_search(search_df=search_item)
+    results     = do_embedding_search(search_df=search_item, limit=limit)
     return results
 
+def search_many(queries, k=3):
+    '''
+    Searches many queries at once: they are embedded in batched requests and the searches
+    run in parallel, one per pooled connection.
+
+    Arguments:
+    queries     :        list of query strings
+    k           :        (Optional) the amount of quotes returned per query
+
+    returns     :        a list with the results of every query, in the same order as queries
+    '''
+    vectors = Embeddings.get_embeddings_bulk(queries)
+    with ThreadPoolExecutor(max_workers=pool.size) as workers:
+        return list(workers.map(lambda emb_ls: get_closest_embeddings(emb_ls, k), vectors))
+
 def get_table(table_name="EMBEDDINGS"):
     '''
     This function returns a table. Mostly used for testing.
@@ -57,20 +170,37 @@ def get_table(table_name="EMBEDDINGS"):
 
     Retruns:     the table as a list of dictionaries.
     '''
-    return cur.execute(f"SELECT * FROM {table_name}").fetchall()
+    with pool.cursor() as cur:
+        return cur.execute(f"SELECT * FROM {table_name}").fetchall()
 
-def get_closest_embeddings(limit=3):
+def get_closest_embeddings(emb_ls, limit=3, type=None, year=None):
     '''
-    This function returns the closest quotes to the embeddings in a table called SEARCH.
+    This function returns the closest quotes to the given embeddings. The embeddings are bound as a
+    parameter of the query, so concurrent searches don't share any table. The filters are applied in
+    the WHERE clause, so the warehouse only ranks the quotes that pass them.
     
     Arguments:
+    emb_ls:      the embeddings of the query as a list.
     limit:       the amount of quotes that the function returns.
+    type:        (Optional) only return quotes of this type, e.g. "movie" or "tv".
+    year:        (Optional) only return quotes of this year, or a (first, last) tuple of years.
 
     Retruns:     quotes, movies and cosine similarity as a list of dictionares.
     '''
-    
-    closest = cur.execute(f'SELECT QUOTE, MOVIE, cosine_similarity(EMBEDDINGS, EMBD) AS score FROM EMBEDDINGS, SEARCH ORDER BY score DESC LIMIT {limit}')
-    return closest.fetchall()
+    params = {"embd": json.dumps([float(x) for x in emb_ls]), "limit": int(limit)}
+    where  = []
+    if type is not None:
+        where.append("LOWER(TYPE) = %(type)s")
+        params["type"] = str(type).lower()
+    if year is not None:
+        where.append("YEAR BETWEEN %(first)s AND %(last)s")
+        params["first"], params["last"] = year if isinstance(year, tuple) else (year, year)
+    sql = "SELECT QUOTE, MOVIE, cosine_similarity(EMBEDDINGS, %(embd)s) AS score FROM EMBEDDINGS"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    with Metrics.span("warehouse_query"), pool.cursor() as cur:
+        closest = cur.execute(sql + " ORDER BY score DESC LIMIT %(limit)s", params)
+        return closest.fetchall()
 
 def create_table(df):
     '''
@@ -79,12 +209,13 @@ def create_table(df):
     Arguments:
     df:          the DataFrame object for which the table is created.
     '''
-    sucs, chunks, rows, out = write_pandas(
-        conn=conn,
-        table_name="SEARCH",
-        df=df,
-        schema=SCHEMA
-    )
+    with Metrics.span("write_pandas"), pool.connection() as conn:
+        sucs, chunks, rows, out = write_pandas(
+            conn=conn,
+            table_name="SEARCH",
+            df=df,
+            schema=SCHEMA
+        )
 
 def empty_table(table_name="SEARCH"):
     '''
@@ -93,11 +224,12 @@ def empty_table(table_name="SEARCH"):
     Arguments:
     table_name:  name of the table to be emptied.          
     '''
-    cur.execute(f"TRUNCATE TABLE IF EXISTS {table_name}")
+    with Metrics.span("truncate"), pool.cursor() as cur:
+        cur.execute(f"TRUNCATE TABLE IF EXISTS {table_name}")
 
 def do_embedding_search(search_df, limit=3):
     '''
-    This function creates a temporary table for search, searches the closest elements and finally empties the temp table.
+    This function searches the closest elements to the embeddings in a single query on a pooled connection.
     
     Arguments:
     search_df:   the embeddings as a df.
@@ -105,10 +237,7 @@ def do_embedding_search(search_df, limit=3):
 
     Retruns:     quotes, movies and cosine similarity as a list of dictionares.
     '''
-    create_table(search_df)
-    closest = get_closest_embeddings(limit)
-    empty_table()
-    return closest
+    return get_closest_embeddings(search_df["EMBD"].iloc[0], limit)
 
 if __name__=="__main__":
     #embedding for hello world    
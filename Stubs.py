@@ -0,0 +1,125 @@
+###########################################################################
+#This file contains local stand-ins for the external services             #
+#They are used by Benchmarks.py, so nothing needs credentials             #
+###########################################################################
+import time
+import json
+import hashlib
+import threading
+from types import SimpleNamespace
+import numpy as np
+
+def fake_embedding(string : str, dimension=1536):
+    '''
+    Makes a deterministic unit length vector for a string, the same string always gets the same vector.
+    '''
+    seed   = int.from_bytes(hashlib.sha256(string.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dimension)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+class StubRateLimitError(Exception):
+    status_code = 429
+
+class StubEmbeddingClient:
+    '''
+    Stands in for the OpenAI client in Embeddings.py. Supports client.embeddings.create(input, model)
+    and sleeps to imitate the latency of the api.
+
+    Arguments:
+    dimension       :    (Optional) the length of the embeddings
+    latency         :    (Optional) seconds every request takes
+    per_input       :    (Optional) extra seconds for every string in a request
+    rate_limit_every:    (Optional) every n-th request fails with a 429 error, 0 turns it off
+    '''
+    def __init__(self, dimension=1536, latency=0.02, per_input=0.0002, rate_limit_every=0):
+        self.dimension        = dimension
+        self.latency          = latency
+        self.per_input        = per_input
+        self.rate_limit_every = rate_limit_every
+        self.requests         = 0
+        self.inputs           = 0
+        self._lock            = threading.Lock()
+        self.embeddings       = self
+
+    def create(self, input, model="text-embedding-3-small"):
+        with self._lock:
+            self.requests += 1
+            count          = self.requests
+        time.sleep(self.latency + self.per_input * len(input))
+        if self.rate_limit_every and count % self.rate_limit_every == 0:
+            raise StubRateLimitError("Rate limit reached")
+        with self._lock:
+            self.inputs += len(input)
+        data = [SimpleNamespace(embedding=fake_embedding(string, self.dimension), index=i) for i, string in enumerate(input)]
+        return SimpleNamespace(data=data, model=model)
+
+class StubCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self._rows      = []
+
+    def execute(self, sql, params=None):
+        if not self.connection.in_use.acquire(blocking=False):
+            raise RuntimeError("connection used by two threads at the same time")
+        try:
+            self._run(params)
+        finally:
+            self.connection.in_use.release()
+        return self
+
+    def _run(self, params):
+        time.sleep(self.connection.latency)
+        if params and "embd" in params:
+            query  = np.array(json.loads(params["embd"]), dtype=np.float32)
+            query /= np.linalg.norm(query) or 1
+            scores = self.connection.vectors @ query
+            if "type" in params:
+                scores[np.array([str(t).lower() != params["type"] for t in self.connection.types])] = -np.inf
+            if "first" in params:
+                years  = np.asarray(self.connection.years, dtype=np.float64)
+                scores[~((years >= params["first"]) & (years <= params["last"]))] = -np.inf
+            best   = [i for i in np.argsort(-scores)[:params["limit"]] if scores[i] > -np.inf]
+            self._rows = [{"QUOTE": self.connection.quotes[i], "MOVIE": self.connection.movies[i], "SCORE": float(scores[i])} for i in best]
+        else:
+            self._rows = []
+        self.connection.queries += 1
+
+    def fetchall(self):
+        return self._rows
+
+    def close(self):
+        pass
+
+class StubSnowflakeConnection:
+    '''
+    Stands in for a snowflake connection in Snowflake_tools.py. It answers the cosine_similarity query
+    from an in-memory corpus after sleeping like a warehouse would, and raises when two threads run
+    queries on it at the same time, so a load test notices when the pool hands one connection out twice.
+
+    Arguments:
+    quotes      :        list of quotes
+    movies      :        list of movies in the same order
+    vectors     :        2d array of unit length embeddings in the same order
+    latency     :        (Optional) seconds every query takes
+    types       :        (Optional) list of types in the same order, for queries filtered on type
+    years       :        (Optional) list of years in the same order, for queries filtered on year
+    '''
+    def __init__(self, quotes, movies, vectors, latency=0.05, types=None, years=None):
+        self.quotes   = quotes
+        self.movies   = movies
+        self.vectors  = vectors
+        self.latency  = latency
+        self.types    = types if types is not None else [None] * len(quotes)
+        self.years    = years if years is not None else [None] * len(quotes)
+        self.queries  = 0
+        self.in_use   = threading.Lock()
+        self._closed  = False
+
+    def cursor(self, cursor_class=None):
+        return StubCursor(self)
+
+    def is_closed(self):
+        return self._closed
+
+    def close(self):
+        self._closed = True
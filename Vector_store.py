@@ -0,0 +1,185 @@
+###########################################################################
+#This file contains functions to save and load the embeddings in binary   #
+###########################################################################
+import os
+import json
+import time
+import hashlib
+import numpy as np
+import pandas as pd
+
+STORE_PATH = os.getenv("LOCAL_STORE", "embeddings")
+
+META_COLUMNS = ["quote", "movie", "type", "year"]
+
+#how often and after how many seconds load_store reads a store again that is being written
+RETRIES    = 1
+RETRY_WAIT = 0.1
+
+def vectors_path(path=STORE_PATH):
+    return f"{path}.npy"
+
+def meta_path(path=STORE_PATH):
+    return f"{path}.meta.json"
+
+def exists(path=STORE_PATH):
+    return os.path.exists(vectors_path(path)) and os.path.exists(meta_path(path))
+
+def canonical(val):
+    '''
+    The value of a column in a form that doesn't depend on the dtype pandas picked for the column:
+    missing values are None, whole numbers are ints (a year column with a missing year is read as
+    float, 1890 becomes 1890.0), other numbers are floats and strings are trimmed.
+    '''
+    if val is None or (not isinstance(val, str) and pd.isna(val)):
+        return None
+    if hasattr(val, "item"):
+        val = val.item()
+    if isinstance(val, str):
+        return val.strip()
+    if isinstance(val, (int, float)) and not isinstance(val, bool):
+        return int(val) if float(val).is_integer() else float(val)
+    return str(val)
+
+def row_hash(row : dict):
+    '''
+    Hash of the content of a row (quote, movie, type and year), used to find the quotes that changed.
+    '''
+    content = [canonical(row.get(col)) for col in META_COLUMNS]
+    return hashlib.sha256(json.dumps(content).encode("utf-8")).hexdigest()
+
+def _normalized(df, col_name):
+    vectors = np.array(df[col_name].tolist(), dtype=np.float32)
+    norms   = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return np.ascontiguousarray(vectors / norms, dtype=np.float32)
+
+def _meta_rows(df, first_id=0):
+    #ids are never reused, so a row keeps its id after other rows were deleted
+    rows = []
+    for row_id, row in enumerate(df.to_dict("records"), start=first_id):
+        meta = {"id": row_id, "hash": row_hash(row)}
+        for col in META_COLUMNS:
+            val       = canonical(row.get(col))
+            #the text is kept as it was, only the numbers are made canonical
+            meta[col] = row.get(col) if isinstance(val, str) else val
+        rows.append(meta)
+    return rows
+
+def write_store(vectors, meta, path=STORE_PATH):
+    '''
+    Writes a store made by make_store or extend_store. The metadata is replaced last, it is the file
+    the running apps watch.
+
+    Arguments:
+    vectors     :        the normalized float32 matrix
+    meta        :        the metadata dictionary
+    path        :        (Optional) the path of the store without the file extension
+    '''
+    # write to temporary files first, so a running app never opens half written files
+    with open(vectors_path(path) + ".tmp", mode="wb") as fl:
+        np.save(fl, vectors)
+    with open(meta_path(path) + ".tmp", mode="w+") as fl:
+        json.dump(meta, fl)
+    os.replace(vectors_path(path) + ".tmp", vectors_path(path))
+    os.replace(meta_path(path) + ".tmp", meta_path(path))
+
+def make_store(df : pd.DataFrame, model="text-embedding-3-small", col_name="embeddings"):
+    '''
+    Makes the vectors and metadata of a new store from a df, without writing them.
+
+    Arguments:
+    df          :        the df made by Embeddings.get_embeddings_for_df
+    model       :        (Optional) the model used to make the embeddings
+    col_name    :        (Optional) the column name of the embeddings
+
+    returns     :        the normalized vectors and the metadata as a dictionary
+    '''
+    vectors = _normalized(df, col_name)
+    rows    = _meta_rows(df)
+    meta = {
+        "model"     : model,
+        "dimension" : int(vectors.shape[1]),
+        "count"     : len(rows),
+        "dtype"     : "float32",
+        "normalized": True,
+        "version"   : 1,
+        "deleted"   : [],
+        "next_id"   : len(rows),
+        "rows"      : rows,
+    }
+    return vectors, meta
+
+def extend_store(df : pd.DataFrame, deleted=(), path=STORE_PATH, model="text-embedding-3-small", col_name="embeddings"):
+    '''
+    Makes the vectors and metadata of an existing store with the rows of a df appended and rows marked
+    as deleted, without writing them. Deleted rows stay in the matrix (so the positions of the other
+    rows don't change) and are skipped by the search.
+
+    Arguments:
+    df          :        the new rows with their embeddings, can be empty
+    deleted     :        (Optional) positions of the rows to mark as deleted
+    path        :        (Optional) the path of the store without the file extension
+    model       :        (Optional) the model used to make the embeddings, must be the model of the store
+    col_name    :        (Optional) the column name of the embeddings
+
+    returns     :        the normalized vectors and the metadata as a dictionary
+    '''
+    vectors, meta = load_store(path)
+    if meta["model"] != model:
+        raise ValueError(f"The store was made with {meta['model']}, not {model}, it has to be made again")
+    if len(df):
+        new = _normalized(df, col_name)
+        if new.shape[1] != meta["dimension"]:
+            raise ValueError(f"The new embeddings have dimension {new.shape[1]}, the store has {meta['dimension']}")
+        vectors = np.concatenate([vectors, new])
+    #stores without next_id got their ids from the df index
+    next_id         = meta.get("next_id", max((row["id"] for row in meta["rows"]), default=-1) + 1)
+    meta["rows"]   += _meta_rows(df, first_id=next_id)
+    meta["next_id"] = next_id + len(df)
+    meta["count"]   = len(meta["rows"])
+    meta["deleted"] = sorted(set(meta.get("deleted", [])) | {int(i) for i in deleted})
+    meta["version"] = meta.get("version", 1) + 1
+    return vectors, meta
+
+def save_store(df : pd.DataFrame, path=STORE_PATH, model="text-embedding-3-small", col_name="embeddings"):
+    '''
+    Saves the embeddings of a df as a raw float32 matrix (path.npy) and the rest of the columns
+    as a small json sidecar (path.meta.json). The vectors are normalized before saving, so they
+    can be searched straight from the memory map.
+
+    Arguments:
+    df          :        the df made by Embeddings.get_embeddings_for_df
+    path        :        (Optional) the path of the store without the file extension
+    model       :        (Optional) the model used to make the embeddings
+    col_name    :        (Optional) the column name of the embeddings
+    '''
+    write_store(*make_store(df, model=model, col_name=col_name), path=path)
+
+def update_store(df : pd.DataFrame, deleted=(), path=STORE_PATH, model="text-embedding-3-small", col_name="embeddings"):
+    '''
+    Appends the embeddings of a df to an existing store and marks rows as deleted, see extend_store.
+    '''
+    write_store(*extend_store(df, deleted=deleted, path=path, model=model, col_name=col_name), path=path)
+
+def load_store(path=STORE_PATH):
+    '''
+    Opens the store made by save_store. The vectors are memory mapped read only, so nothing is
+    parsed or copied at startup and every worker process shares the same page cache.
+
+    Arguments:
+    path        :        (Optional) the path of the store without the file extension
+
+    returns     :        the vectors as a read only np.memmap and the metadata as a dictionary
+    '''
+    #write_store replaces the vectors right before the metadata, a reader in between sees the new
+    #vectors with the old metadata, so it reads both again once the metadata had time to follow
+    for attempt in range(RETRIES + 1):
+        with open(meta_path(path)) as fl:
+            meta = json.load(fl)
+        vectors = np.load(vectors_path(path), mmap_mode="r")
+        if vectors.shape == (meta["count"], meta["dimension"]):
+            return vectors, meta
+        if attempt < RETRIES:
+            time.sleep(RETRY_WAIT)
+    raise ValueError(f"{vectors_path(path)} has shape {vectors.shape}, but the metadata expects {(meta['count'], meta['dimension'])}")
@@ -2,14 +2,48 @@
 # This file is for the flask app                                                                        #
 #########################################################################################################
 
-from flask import Flask, request, render_template
-import Embeddings
-import Snowflake_tools
+from flask import Flask, request, render_template, jsonify, Response, abort
+import Search
+import Metrics
+import Local_search
+import Embedding_cache
 from dotenv import load_dotenv
 import os
+import threading
 
 app = Flask(__name__)
 
+def cache_stat(key):
+    #read only when the cache exists, a scrape shouldn't create the sqlite file
+    return lambda: (Embedding_cache.cache_stats() or {}).get(key)
+
+Metrics.registry.gauge("search_corpus_size", "Amount of quotes in the local search engine.", Local_search.corpus_size)
+Metrics.registry.gauge("embedding_cache_hit_rate", "Share of embedding lookups answered by the cache.", cache_stat("hit_rate"))
+Metrics.registry.counter("embedding_cache_memory_hits_total", "Embedding lookups answered from memory.", cache_stat("memory_hits"))
+Metrics.registry.counter("embedding_cache_disk_hits_total", "Embedding lookups answered from the sqlite file.", cache_stat("disk_hits"))
+Metrics.registry.counter("embedding_cache_misses_total", "Embedding lookups that needed a request to OpenAI.", cache_stat("misses"))
+
+if Metrics.profiler is not None:
+    Metrics.profiler.start()
+
+def warm_up():
+    try:
+        Search.warm_up()
+    except Exception as error:
+        app.logger.warning(f"Warming up the search backend failed, it is loaded on the first search: {error!r}")
+
+def start_warm_up():
+    '''
+    Loads the backends in a background thread, so the app serves "/" right away. It starts when the
+    app is imported (e.g. by gunicorn), WARM_UP=0 turns it off, e.g. for the benchmarks.
+    '''
+    thread = threading.Thread(target=warm_up, daemon=True)
+    thread.start()
+    return thread
+
+if os.getenv("WARM_UP", "1") != "0":
+    start_warm_up()
+
 @app.route("/")
 def search():
     return render_template("search.html")
@@ -17,9 +51,59 @@ def search():
 @app.route('/search')
 def get_search():
     query = request.args.get('query')
-    if len(query)<=250:
-        results = Snowflake_tools.search_query(query)
-    return render_template("results.html", query=query, results=results)
+    mode  = request.args.get('mode') if request.args.get('mode') in Search.MODES else None
+    type  = request.args.get('type') or None
+    year  = request.args.get('year', type=int)
+    Metrics.registry.count("search_requests_total")
+    results = None
+    with Metrics.span("search_request"):
+        if len(query)<=250:
+            results = Search.search_query(query, mode=mode, type=type, year=year)
+        with Metrics.span("render"):
+            return render_template("results.html", query=query, results=results)
+
+MAX_QUERY_LENGTH = 250
+MAX_BATCH        = 1000
+MAX_K            = 100
+
+@app.route('/api/search/batch', methods=["POST"])
+def get_search_batch():
+    '''
+    Searches many queries in one request.
+    Expects json like {"queries": ["...", "..."], "k": 3} and returns {"results": [[...], [...]]}.
+    '''
+    body    = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return jsonify(error="the body must be a json object"), 400
+    queries = body.get("queries")
+    k       = body.get("k", 3)
+    if not isinstance(queries, list) or not all(isinstance(query, str) for query in queries):
+        return jsonify(error="queries must be a list of strings"), 400
+    if len(queries) > MAX_BATCH:
+        return jsonify(error=f"at most {MAX_BATCH} queries per request"), 400
+    #the embeddings api rejects empty input
+    if any(not query.strip() for query in queries):
+        return jsonify(error="queries must not be empty"), 400
+    if any(len(query) > MAX_QUERY_LENGTH for query in queries):
+        return jsonify(error=f"every query must be at most {MAX_QUERY_LENGTH} characters long"), 400
+    if not isinstance(k, int) or isinstance(k, bool) or not 1 <= k <= MAX_K:
+        return jsonify(error=f"k must be a number from 1 to {MAX_K}"), 400
+    Metrics.registry.count("search_batch_requests_total")
+    with Metrics.span("search_batch_request"):
+        return jsonify(results=Search.search_many(queries, k))
+
+@app.route('/metrics')
+def get_metrics():
+    return Response(Metrics.registry.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route('/debug/profile')
+def get_profile():
+    '''
+    Returns the stacks counted by the sampling profiler, only when the app runs with PROFILE_SAMPLING=1.
+    '''
+    if Metrics.profiler is None:
+        abort(404)
+    return Response(Metrics.profiler.collapsed(), mimetype="text/plain")
 
 if __name__=="__main__":
     app.run(port = os.getenv("PORT"))
@@ -0,0 +1,7 @@
+import os
+import sys
+
+#the modules live in the root of the repository, and Quotes.py reads data.json from the working directory
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
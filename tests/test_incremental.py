@@ -0,0 +1,82 @@
+###########################################################################
+#Tests of the incremental update of the store made by Quotes.py           #
+###########################################################################
+import json
+import pandas as pd
+import pytest
+import Embeddings
+import Embedding_cache
+import Stubs
+import Vector_store
+import Quotes
+
+@pytest.fixture
+def client():
+    Embedding_cache.set_cache(Embedding_cache.EmbeddingCache(path=None, maxsize=0))
+    Embeddings.client = Stubs.StubEmbeddingClient(dimension=8, latency=0, per_input=0)
+    return Embeddings.client
+
+@pytest.fixture
+def quotes():
+    return pd.DataFrame([
+        {"quote": f"quote {i}", "movie": f"movie {i}", "type": "movie", "year": 1900 + i}
+        for i in range(10)
+    ])
+
+@pytest.fixture
+def store(tmp_path, client, quotes):
+    path = str(tmp_path / "embeddings")
+    df   = quotes.copy()
+    Embeddings.get_embeddings_for_df(df=df, model=Quotes.MODEL)
+    Vector_store.save_store(df, path=path, model=Quotes.MODEL)
+    return path
+
+def write_data(tmp_path, records):
+    path = tmp_path / "data.json"
+    path.write_text(json.dumps(records))
+    return Quotes.load_quotes(str(path))
+
+def test_appended_row_without_year_only_adds_that_row(tmp_path, store, quotes, client):
+    #one entry without a year makes pandas read the whole year column as float
+    records = quotes.to_dict("records") + [{"quote": "no year", "movie": "somewhere", "type": "tv"}]
+    df      = write_data(tmp_path, records)
+    assert df["year"].dtype == float
+
+    assert Quotes.update_corpus(df, path=store) == (1, 0)
+    assert client.inputs == 10 + 1
+    vectors, meta = Vector_store.load_store(store)
+    assert len(meta["rows"]) == 11
+    assert meta["rows"][-1]["year"] is None
+    assert meta["rows"][0]["year"] == 1900
+
+def test_update_adds_changes_and_deletes_rows(store, quotes, client):
+    df = quotes.drop(index=[2, 5]).copy()
+    df.loc[7, "quote"] = "quote 7, changed"
+    df = pd.concat([df, pd.DataFrame([{"quote": "new", "movie": "new movie", "type": "movie", "year": 2000}])], ignore_index=True)
+
+    #the changed quote is added again and its old row deleted
+    assert Quotes.update_corpus(df, path=store) == (2, 3)
+    assert client.inputs == 10 + 2
+    vectors, meta = Vector_store.load_store(store)
+    assert meta["count"] == len(vectors) == 12
+    assert meta["deleted"] == [2, 5, 7]
+    live = [row["quote"] for i, row in enumerate(meta["rows"]) if i not in meta["deleted"]]
+    assert sorted(live) == sorted(df["quote"])
+
+def test_update_without_changes_writes_nothing(store, quotes, client):
+    meta_before = Vector_store.load_store(store)[1]
+    assert Quotes.update_corpus(quotes.copy(), path=store) == (0, 0)
+    assert client.inputs == 10
+    assert Vector_store.load_store(store)[1] == meta_before
+
+def test_ids_stay_unique_after_deletes(store, quotes, client):
+    df = quotes.drop(index=[0, 1, 2, 3, 4]).reset_index(drop=True)
+    df = pd.concat([df, pd.DataFrame([{"quote": f"added {i}", "movie": "m", "type": "movie", "year": 2000} for i in range(11)])], ignore_index=True)
+    Quotes.update_corpus(df, path=store)
+    Quotes.update_corpus(df.drop(index=[0]), path=store)
+    Quotes.update_corpus(pd.concat([df, pd.DataFrame([{"quote": "last", "movie": "m", "type": "movie", "year": 2001}])], ignore_index=True), path=store)
+
+    meta = Vector_store.load_store(store)[1]
+    ids  = [row["id"] for row in meta["rows"]]
+    assert len(ids) == len(set(ids))
+    assert meta["next_id"] == max(ids) + 1
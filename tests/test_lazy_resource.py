@@ -0,0 +1,61 @@
+###########################################################################
+#Tests of the hot swap in Lazy_resource.py                                #
+###########################################################################
+import time
+import threading
+import pandas as pd
+import Local_search
+import Stubs
+import Vector_store
+from Lazy_resource import LazyResource
+
+def make_store(path, quotes):
+    df = pd.DataFrame({"quote": quotes, "movie": ["m"] * len(quotes), "type": ["movie"] * len(quotes), "year": [2000] * len(quotes)})
+    df["embeddings"] = [Stubs.fake_embedding(quote, 8) for quote in quotes]
+    Vector_store.write_store(*Vector_store.make_store(df), path=path)
+
+def wait_for(condition, timeout=5):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+def test_engine_is_swapped_after_write_store(tmp_path):
+    path   = str(tmp_path / "embeddings")
+    make_store(path, ["first", "second"])
+    engine = LazyResource(lambda: Local_search.LocalSearch.from_store(path), watch=lambda: Vector_store.meta_path(path), interval=0)
+    old    = engine.get()
+    assert len(old) == 2
+
+    make_store(path, ["first", "second", "third"])
+    #the old engine keeps serving while the new one loads
+    assert engine.get() is old
+    assert wait_for(lambda: engine.get() is not old)
+    assert len(engine.get()) == 3
+    assert engine.get().search(Stubs.fake_embedding("third", 8), 1)[0]["QUOTE"] == "third"
+
+def test_concurrent_checks_start_one_reload(tmp_path):
+    watched = tmp_path / "watched"
+    watched.write_text("1")
+    loads   = []
+    release = threading.Event()
+
+    def load():
+        loads.append(1)
+        if len(loads) > 1:
+            release.wait(5)
+        return len(loads)
+
+    resource = LazyResource(load, watch=lambda: str(watched), interval=0)
+    assert resource.get() == 1
+    watched.write_text("22")
+    threads = [threading.Thread(target=resource.get) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    release.set()
+    assert wait_for(lambda: resource.get() == 2)
+    assert len(loads) == 2